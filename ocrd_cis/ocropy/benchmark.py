@@ -0,0 +1,539 @@
+"""Micro-benchmarks (with equivalence checks) for the Ocropy implementation.
+
+Run e.g. ``python -m ocrd_cis.ocropy.benchmark lstm-forward --help``.
+"""
+from __future__ import absolute_import
+
+import pickle
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from time import perf_counter, process_time
+from timeit import repeat
+from unittest import mock
+
+import click
+import numpy as np
+from PIL import Image
+from scipy.ndimage import center_of_mass, find_objects
+from skimage.morphology import medial_axis
+from rapidfuzz.distance import Levenshtein
+
+from . import common
+from .ocrolib import lstm, morph, psegutils, sl, allsplitext, load_object, save_object
+from .ocropus_rtrain import CheckpointWriter, snapshot_network
+from .recognize import decode, load_network, preprocess, recognize_batch, resize_keep_ratio
+
+
+def timed(fun, number=3, rounds=5):
+    """Return the best average time (in seconds) of calling ``fun``."""
+    return min(repeat(fun, number=number, repeat=rounds)) / number
+
+
+@click.group()
+def benchmark():
+    """Benchmark optimized code paths against their reference implementation."""
+
+
+@benchmark.command('lstm-forward')
+@click.option('-W', '--width', default=1500, help='number of time steps (line width)')
+@click.option('-H', '--height', default=48, help='number of inputs (line height)')
+@click.option('-S', '--states', default=100, help='number of LSTM state units')
+def lstm_forward(width, height, states):
+    """Compare the (training) forward pass of a single LSTM layer with
+    the fused-gate inference kernel on a random line."""
+    np.random.seed(0)
+    layer = lstm.LSTM(height, states)
+    xs = np.random.rand(width, height)
+    expected = np.array(layer.forward(xs))
+    actual = np.array(layer.predict(xs))
+    click.echo(f"max. abs. difference: {np.amax(np.abs(expected - actual)):.3g}")
+    old = timed(lambda: layer.forward(xs))
+    new = timed(lambda: layer.predict(xs))
+    click.echo(f"forward: {1000 * old:.1f} ms, predict: {1000 * new:.1f} ms, speedup: {old / new:.2f}")
+
+
+@benchmark.command('precision')
+@click.option('-m', '--model', required=True, help='path of the model file (e.g. fraktur.pyrnn.gz)')
+@click.option('-b', '--batch-size', default=1, help='number of lines to recognize at once')
+@click.argument('images', nargs=-1, required=True)
+def precision(model, batch_size, images):
+    """Compare recognition with float32 against float64 model weights
+    on the text line IMAGES (with optional ground truth in .gt.txt files).
+
+    Prints the lines where both results differ, and the character error
+    rates (CER) between them and against the ground truth.
+    """
+    lines = [resize_keep_ratio(Image.open(path))[0] for path in images]
+    gts = []
+    for path in images:
+        base, _ = allsplitext(path)
+        if exists(base + '.gt.txt'):
+            with open(base + '.gt.txt', encoding='utf-8') as f:
+                gts.append(f.read().strip())
+        else:
+            gts.append(None)
+    results = {}
+    for dtype in ['float64', 'float32']:
+        network = load_network(model, precision=dtype)
+        start = process_time()
+        results[dtype] = []
+        for i in range(0, len(lines), batch_size):
+            results[dtype].extend(recognize_batch(lines[i:i + batch_size], 16, network))
+        click.echo(f"{dtype}: {process_time() - start:.2f}s CPU")
+    edits = lengs = 0
+    gt_edits = {'float64': 0, 'float32': 0}
+    gt_lengs = 0
+    for path, gt, res64, res32 in zip(images, gts, results['float64'], results['float32']):
+        if isinstance(res64, Exception) or isinstance(res32, Exception):
+            click.echo(f"{path}: skipped ({res64 if isinstance(res64, Exception) else res32})")
+            continue
+        pred64, pred32 = res64[0], res32[0]
+        if pred64 != pred32:
+            click.echo(f"{path}:\n  float64: {pred64!r}\n  float32: {pred32!r}")
+        edits += Levenshtein.distance(pred32, pred64)
+        lengs += len(pred64)
+        if gt is not None:
+            gt_edits['float64'] += Levenshtein.distance(pred64, gt)
+            gt_edits['float32'] += Levenshtein.distance(pred32, gt)
+            gt_lengs += len(gt)
+    click.echo(f"CER float32 vs. float64: {100.0 * edits / max(1, lengs):.3f}% ({edits} of {lengs} chars)")
+    if gt_lengs:
+        for dtype in gt_edits:
+            click.echo(f"CER {dtype} vs. GT: {100.0 * gt_edits[dtype] / gt_lengs:.3f}%")
+
+
+
+@benchmark.command('chunked')
+@click.option('-m', '--model', required=True, help='path of the model file (e.g. fraktur.pyrnn.gz)')
+@click.option('-c', '--chunk', default=2000, help='number of time steps per window')
+@click.option('-o', '--overlap', default=200, help='number of time steps of context for the reverse direction')
+@click.argument('images', nargs=-1, required=True)
+def chunked(model, chunk, overlap, images):
+    """Compare chunked against whole-line prediction on one long line,
+    concatenated from the text line IMAGES.
+
+    Prints the maximum difference of the output activations, the
+    character error rate (CER) between both results, and their timing.
+    """
+    lines = [resize_keep_ratio(Image.open(path).convert('L'))[0] for path in images]
+    image = Image.new('L', (sum(line.width for line in lines), 48), 255)
+    x = 0
+    for line in lines:
+        image.paste(line, (x, 0))
+        x += line.width
+    line, width = preprocess(image, 16, check=False)
+    network = load_network(model)
+    for x in network.walk():
+        if isinstance(x, lstm.LSTM):
+            x.allocate(len(line), inference=True)
+    expected = np.array(network.lstm.predict(line))
+    actual = network.lstm.predictChunked(line, chunk, overlap)
+    click.echo(f"{len(line)} time steps, max. abs. difference: {np.amax(np.abs(expected - actual)):.3g}")
+    pred_expected = decode(expected, 16, width, network)[0]
+    pred_actual = decode(actual, 16, width, network)[0]
+    edits = Levenshtein.distance(pred_actual, pred_expected)
+    click.echo(f"CER chunked vs. whole: {100.0 * edits / max(1, len(pred_expected)):.3f}% "
+               f"({edits} of {len(pred_expected)} chars)")
+    old = timed(lambda: network.lstm.predict(line), number=1, rounds=3)
+    new = timed(lambda: network.lstm.predictChunked(line, chunk, overlap), number=1, rounds=3)
+    click.echo(f"whole: {old:.2f}s, chunked: {new:.2f}s")
+
+
+@benchmark.command('train-batch')
+@click.option('-b', '--batch-size', default=8, help='number of lines per batch')
+@click.option('-W', '--width', default=600, help='maximum number of time steps (line width)')
+@click.option('-S', '--states', default=100, help='number of LSTM state units')
+def train_batch(batch_size, width, states):
+    """Compare minibatch training against training on each line in turn
+    on random lines: the weight deltas of the batch must equal the sum of
+    the deltas of its lines."""
+    np.random.seed(0)
+    codec = lstm.Codec().init(lstm.ascii_labels)
+    network = lstm.SeqRecognizer(48, states, codec=codec)
+    lines = [np.random.rand(np.random.randint(width // 3, width + 1), 48) for _ in range(batch_size)]
+    css = [np.array(codec.encode("the text %d" % i), 'i') for i in range(batch_size)]
+    expected = None
+    for xs, cs in zip(lines, css):
+        network.trainSequence(xs, cs, update=0)
+        deltas = [dw.copy() for _, dw, _ in network.lstm.weights()]
+        expected = deltas if expected is None else [e + d for e, d in zip(expected, deltas)]
+    network.trainBatch(lines, css, update=0)
+    diff = max(np.amax(np.abs(e - dw)) / max(1e-12, np.amax(np.abs(e)))
+               for e, (_, dw, _) in zip(expected, network.lstm.weights()))
+    click.echo(f"max. rel. difference of weight deltas: {diff:.3g}")
+    old = timed(lambda: [network.trainSequence(xs, cs, update=0) for xs, cs in zip(lines, css)], number=1)
+    new = timed(lambda: network.trainBatch(lines, css, update=0), number=1)
+    click.echo(f"per line: sequential {1000 * old / batch_size:.1f} ms, "
+               f"batch {1000 * new / batch_size:.1f} ms, speedup: {old / new:.2f}")
+
+
+def forwardbackward_reference(lmatch, skip=-5.0):
+    """The previous implementation of ``lstm.forwardbackward``
+    (building up the result row by row)."""
+    def log_add(x, y):
+        return np.where(np.abs(x - y) > 10, np.maximum(x, y), np.log(np.exp(np.clip(x - y, -20, 20)) + 1) + y)
+
+    def forward_algorithm(match):
+        v = skip * np.arange(len(match[0]))
+        result = []
+        for i in range(0, len(match)):
+            w = np.roll(v, 1).copy()
+            w[0] = skip * i
+            v = log_add(v + match[i], w + match[i])
+            result.append(v)
+        return np.array(result, 'f')
+
+    return forward_algorithm(lmatch) + forward_algorithm(lmatch[::-1, ::-1])[::-1, ::-1]
+
+
+@benchmark.command('ctc')
+@click.option('-T', '--steps', default=2000, help='number of time steps (network outputs)')
+@click.option('-S', '--states', default=200, help='number of CTC states (target sequence)')
+def ctc(steps, states):
+    """Compare the log-space forward-backward algorithm of the CTC
+    alignment against its previous implementation on random matches."""
+    np.random.seed(0)
+    lmatch = np.log(np.maximum(1e-5, np.random.rand(steps, states)))
+    expected = forwardbackward_reference(lmatch)
+    actual = lstm.forwardbackward(lmatch)
+    click.echo(f"max. abs. difference: {np.amax(np.abs(expected - actual)):.3g} "
+               f"({np.mean(expected == actual) * 100:.1f}% identical)")
+    old = timed(lambda: forwardbackward_reference(lmatch))
+    new = timed(lambda: lstm.forwardbackward(lmatch))
+    click.echo(f"previous: {1000 * old:.1f} ms, vectorized: {1000 * new:.1f} ms, speedup: {old / new:.2f}")
+
+
+@benchmark.command('checkpoint')
+@click.option('-m', '--model', required=True, help='path of the model file (e.g. fraktur.pyrnn.gz)')
+def checkpoint(model):
+    """Compare saving a checkpoint during training by stripping the
+    network itself (and reallocating its state afterwards) against
+    saving a snapshot of it in the background.
+
+    Prints whether both pickle identically, and how long training
+    has to wait for each.
+    """
+    network = load_object(model, nofind=1)
+    for x in network.walk():
+        x.postLoad()
+
+    def strip_save(save):
+        # the previous way: strip the network itself, then reallocate
+        network.clear_log()
+        for x in network.walk():
+            x.preSave()
+        result = save(network)
+        for x in network.walk():
+            x.postLoad()
+        return result
+    expected = strip_save(lambda net: pickle.dumps(net, 2))
+    actual = pickle.dumps(snapshot_network(network), 2)
+    click.echo(f"identical pickles: {expected == actual}")
+    with TemporaryDirectory() as tmpdir:
+        writer = CheckpointWriter()
+        start = perf_counter()
+        strip_save(lambda net: save_object(join(tmpdir, 'old.pyrnn.gz'), net))
+        old = perf_counter() - start
+        start = perf_counter()
+        writer.save(join(tmpdir, 'new.pyrnn.gz'), network, 0)
+        new = perf_counter() - start
+        writer.close()
+    click.echo(f"training waits: synchronous {1000 * old:.1f} ms, background {1000 * new:.1f} ms")
+
+
+def line_seeds_reference(bmarked, tmarked, scale, robust=True):
+    """The previous implementation of ``common.mark_line_seeds``
+    (visiting the marks of each column in turn)."""
+    seeds = np.zeros(bmarked.shape, 'i')
+    delta = max(3, int(scale))
+    for x in range(bmarked.shape[1]):
+        transitions = sorted([(y, 1) for y in psegutils.find(bmarked[:, x])] +
+                             [(y, 0) for y in psegutils.find(tmarked[:, x])])[::-1]
+        if robust:
+            for l, (y0, s0) in enumerate(transitions):
+                if s0:
+                    y1 = max(0, y0 - delta)
+                    if l + 1 < len(transitions) and transitions[l + 1][0] > y1:
+                        y1 = transitions[l + 1][0]
+                    seeds[y1:y0, x] = 1
+                else:
+                    y1 = y0 + delta
+                    if l > 0 and transitions[l - 1][0] < y1:
+                        y1 = transitions[l - 1][0]
+                    seeds[y0:y1, x] = 1
+        else:
+            transitions += [(0, 0)]
+            for l in range(len(transitions) - 1):
+                y0, s0 = transitions[l]
+                if s0 == 0:
+                    continue
+                seeds[y0 - delta:y0, x] = 1
+                y1, s1 = transitions[l + 1]
+                if s1 == 0 and (y0 - y1) < 5 * scale:
+                    seeds[y1:y0, x] = 1
+    return seeds
+
+
+@benchmark.command('line-seeds')
+@click.argument('images', nargs=-1, required=True)
+def line_seeds(images):
+    """Compare marking line seeds between the bottom and top marks of
+    the binarized page IMAGES against the previous implementation, in
+    robust and in legacy mode.
+
+    Prints whether both results are identical, and their timing.
+    """
+    for path in images:
+        binary = np.array(np.array(Image.open(path).convert('L')) < 128, np.uint8)
+        scale = psegutils.estimate_scale(binary)
+        bottom, top, _ = common.compute_gradmaps(binary, scale)
+        colseps = np.zeros_like(binary)
+        for robust in [True, False]:
+            # get the marks from the actual gradient maps
+            with mock.patch.object(common, 'mark_line_seeds', wraps=common.mark_line_seeds) as marker:
+                common.compute_line_seeds(binary, bottom, top, colseps, scale, robust=robust)
+            args = marker.call_args.args
+            expected = line_seeds_reference(*args, robust=robust)
+            actual = common.mark_line_seeds(*args, robust=robust)
+            old = timed(lambda: line_seeds_reference(*args, robust=robust), number=1)
+            new = timed(lambda: common.mark_line_seeds(*args, robust=robust), number=1)
+            click.echo(f"{path} ({'robust' if robust else 'legacy'}): "
+                       f"identical: {np.array_equal(expected, actual)}, "
+                       f"per column: {1000 * old:.1f} ms, vectorized: {1000 * new:.1f} ms, "
+                       f"speedup: {old / new:.2f}")
+
+
+def hmerge_line_seeds_reference(binary, seeds, scale, threshold=0.8, seps=None):
+    """The previous implementation of ``common.hmerge_line_seeds``
+    (checking all pairs of seeds on full-page masks)."""
+    labels = np.unique(seeds * (binary > 0))
+    labels = labels[labels > 0]
+    seeds[~np.isin(seeds, labels, assume_unique=True)] = 0
+    if len(labels) < 2:
+        return seeds
+    objects = find_objects(seeds)
+    centers = center_of_mass(binary, seeds, labels)
+    relabel = np.arange(np.max(seeds) + 1, dtype=seeds.dtype)
+
+    def h_compatible(obj1, obj2, center1, center2):
+        return (obj2[0].start < center1[0] < obj2[0].stop and
+                obj1[0].start < center2[0] < obj1[0].stop and
+                not obj2[1].start < center1[1] < obj2[1].stop and
+                not obj1[1].start < center2[1] < obj1[1].stop)
+    for label in labels:
+        seed = seeds == label
+        if not seed.any():
+            continue
+        seed = morph.rb_closing(seed, (scale, scale))
+        if not seed.any():
+            continue
+        obj = find_objects(seed)[0]
+        if obj is None:
+            continue
+        seed[obj[0], 0:seed.shape[1]] = 1
+        for label2 in labels:
+            if label == label2 or relabel[label] == label2:
+                continue
+            obj2 = objects[label2 - 1]
+            if not obj2:
+                continue
+            if not sl.yoverlaps(obj, obj2):
+                continue
+            center = centers[labels.searchsorted(label)]
+            bbox = objects[label - 1]
+            if not all(h_compatible(bbox, bbox2, center, center2)
+                       for bbox2, center2 in [(objects[i - 1], centers[labels.searchsorted(i)])
+                                              for i in np.nonzero(relabel == relabel[label2])[0]]):
+                continue
+            seed2 = seeds == label2
+            count = np.count_nonzero(seed2 * seed)
+            total = np.count_nonzero(seed2)
+            if count < threshold * total:
+                continue
+            label1_y, label1_x = np.where(seeds == label)
+            label2_y, label2_x = np.where(seed2)
+            shared_y = np.intersect1d(label1_y, label2_y)
+            gap = np.zeros_like(seed2, bool)
+            for y in shared_y:
+                can_x_min = label2_x[label2_y == y][0]
+                can_x_max = label2_x[label2_y == y][-1]
+                new_x_min = label1_x[label1_y == y][0]
+                new_x_max = label1_x[label1_y == y][-1]
+                if can_x_max < new_x_min:
+                    if seps is None or not seps[y, can_x_max:new_x_min].any():
+                        gap[y, can_x_max:new_x_min] = True
+                if new_x_max < can_x_min:
+                    if seps is None or not seps[y, new_x_max:can_x_min].any():
+                        gap[y, new_x_max:can_x_min] = True
+            if not gap.any() or gap.max(axis=1).sum() / len(shared_y) < 0.1:
+                continue
+            gapwidth = gap.sum(axis=1)
+            gapwidth[gapwidth == 0] = seed.shape[1]
+            mingap = gapwidth < gapwidth.min() + 4
+            mingap = mingap.nonzero()[0]
+            gap[0:mingap[0]] = False
+            gap[mingap[-1]:] = False
+            seeds[gap] = label
+            new_label = relabel[label]
+            relabel[label2] = new_label
+            relabel[relabel == label2] = new_label
+    return relabel[seeds]
+
+
+@benchmark.command('hmerge')
+@click.option('-s', '--seps', is_flag=True, help='also pass the column separators as seps')
+@click.argument('images', nargs=-1, required=True)
+def hmerge(seps, images):
+    """Compare merging the line seeds of the binarized page IMAGES
+    horizontally against the previous implementation.
+
+    Prints whether both results are identical, and their timing.
+    """
+    for path in images:
+        binary = np.array(np.array(Image.open(path).convert('L')) < 128, np.uint8)
+        scale = psegutils.estimate_scale(binary)
+        bottom, top, _ = common.compute_gradmaps(binary, scale)
+        colseps = common.compute_colseps_conv(binary, scale) if seps else np.zeros_like(binary)
+        seeds = common.compute_line_seeds(binary, bottom, top, colseps, scale)
+        sepmask = colseps if seps else None
+        expected = hmerge_line_seeds_reference(binary, seeds.copy(), scale, seps=sepmask)
+        actual = common.hmerge_line_seeds(binary, seeds.copy(), scale, seps=sepmask)
+        old = timed(lambda: hmerge_line_seeds_reference(binary, seeds.copy(), scale, seps=sepmask),
+                    number=1, rounds=1)
+        new = timed(lambda: common.hmerge_line_seeds(binary, seeds.copy(), scale, seps=sepmask),
+                    number=1, rounds=3)
+        click.echo(f"{path}: {np.max(seeds)} seeds, identical: {np.array_equal(expected, actual)}, "
+                   f"all pairs: {old:.2f}s, overlapping pairs: {new:.2f}s, speedup: {old / new:.2f}")
+
+
+@benchmark.command('seplines')
+@click.option('-n', '--number', default=500, help='number of skeleton components to compare')
+@click.argument('images', nargs=-1, required=True)
+def seplines(number, images):
+    """Compare the size and the median and standard deviation of the
+    distances of the skeleton components of the binarized page IMAGES
+    (as used for separator detection) against computing them on the
+    full-page mask of each component, for the first NUMBER components.
+
+    Prints the differences and timing, and the time of the complete
+    separator detection (and its medial axis transform).
+    """
+    for path in images:
+        binary = np.array(Image.open(path).convert('L')) < 128
+        scale = psegutils.estimate_scale(binary)
+        start = perf_counter()
+        skel, dist = medial_axis(binary, return_distance=True, rng=0)
+        axis = perf_counter() - start
+        labels, nlabels = morph.label(skel)
+        count = min(number, nlabels)
+        start = perf_counter()
+        expected = np.zeros((3, count))
+        for label in range(1, count + 1):
+            labelmask = labels == label
+            distances = dist[labelmask]
+            expected[:, label - 1] = np.count_nonzero(labelmask), np.median(distances), np.std(distances)
+        old = (perf_counter() - start) / count
+        start = perf_counter()
+        actual = np.array(common.label_distances(labels, nlabels, dist))[:, :count]
+        new = perf_counter() - start
+        click.echo(f"{path}: {nlabels} components, identical sizes: {np.array_equal(expected[0], actual[0])}, "
+                   f"medians: {np.array_equal(expected[1], actual[1])}, "
+                   f"max. rel. difference of stds: {np.amax(np.abs(expected[2] - actual[2]) / np.maximum(1e-12, expected[2])):.3g}")
+        click.echo(f"per component: {1000 * old:.1f} ms (all: {old * nlabels:.1f}s), "
+                   f"all at once: {1000 * new:.1f} ms")
+        with mock.patch.object(common, 'medial_axis', lambda *args, **kwargs: (skel, dist)):
+            start = perf_counter()
+            common.compute_seplines(binary, scale, maxseps=20)
+            total = perf_counter() - start
+        click.echo(f"compute_seplines: {axis + total:.2f}s (medial axis: {axis:.2f}s)")
+
+
+def match_lines(labels1, labels2, binary, threshold=0.5):
+    """Count the lines in ``labels1`` which have a unique counterpart in ``labels2``,
+    i.e. one with an intersection over union of their foreground larger than ``threshold``."""
+    labels1 = labels1[binary]
+    labels2 = labels2[binary]
+    n1, n2 = np.amax(labels1) + 1, np.amax(labels2) + 1
+    sizes1 = np.bincount(labels1, minlength=n1)
+    sizes2 = np.bincount(labels2, minlength=n2)
+    pairs = np.bincount(labels1 * n2 + labels2, minlength=n1 * n2).reshape(n1, n2)
+    iou = pairs / np.maximum(1, sizes1[:, np.newaxis] + sizes2[np.newaxis, :] - pairs)
+    return np.count_nonzero(iou[1:, 1:] > threshold)
+
+
+@benchmark.command('downscale')
+@click.option('-d', '--dpi', default=600, help='pixel density of the IMAGES')
+@click.option('-t', '--target', default=300, help='pixel density to segment at')
+@click.argument('images', nargs=-1, required=True)
+def downscale(dpi, target, images):
+    """Compare page segmentation (lines and regions) of the binarized
+    IMAGES at their native resolution against segmentation at reduced
+    resolution (with the line labels mapped back to the native one).
+
+    Prints the timing of both, and the F1 score of the reduced lines
+    (with the native lines as reference, matching foreground IoU > 0.5).
+    """
+    def segment(binary, zoom):
+        line_labels, _, seplines, images, colseps, scale = common.compute_segmentation(
+            binary, zoom=zoom, fullpage=True, spread_dist=round(2.4 / zoom * 300 / 72),
+            maxcolseps=20, maxseps=20, maximages=10)
+        sepmask = np.maximum(seplines > 0, np.maximum(images > 0, colseps))
+        common.lines2regions(binary, line_labels, sepmask=sepmask, scale=scale, zoom=zoom)
+        return line_labels
+
+    for path in images:
+        binary = np.array(Image.open(path).convert('L')) < 128
+        factor = target / dpi
+        size = (round(binary.shape[1] * factor), round(binary.shape[0] * factor))
+        start = perf_counter()
+        expected = segment(binary, 300 / dpi)
+        old = perf_counter() - start
+        start = perf_counter()
+        actual = segment(common.downscale_binary(binary, size), 300 / target)
+        actual = common.upscale_labels(actual, binary.shape)
+        new = perf_counter() - start
+        matches = match_lines(expected, actual, binary)
+        nexpected, nactual = len(np.unique(expected)) - 1, len(np.unique(actual)) - 1
+        precision, recall = matches / max(1, nactual), matches / max(1, nexpected)
+        click.echo(f"{path}: {nexpected} lines at {dpi} DPI: {old:.2f}s, "
+                   f"{nactual} lines at {target} DPI: {new:.2f}s, speedup: {old / new:.2f}, "
+                   f"F1: {2 * precision * recall / max(1e-12, precision + recall):.3f} "
+                   f"(P: {precision:.3f}, R: {recall:.3f})")
+
+
+@benchmark.command('strips')
+@click.option('-j', '--jobs', default=common.available_cpus(), help='number of strips (and threads)')
+@click.argument('images', nargs=-1, required=True)
+def strips(jobs, images):
+    """Compare computing the gradient maps, whitespace column separators
+    and line seeds of the binarized page IMAGES in parallel strips
+    against computing them on the whole page.
+
+    Prints whether all results are identical, and their timing.
+    """
+    def compute(binary, scale):
+        bottom, top, _ = common.compute_gradmaps(binary, scale)
+        colseps = common.compute_colseps_conv(binary, scale, maxcolseps=20)
+        seeds = common.compute_line_seeds(binary, bottom, top, colseps.astype(np.uint8), scale)
+        return bottom, top, colseps, seeds
+
+    for path in images:
+        binary = np.array(np.array(Image.open(path).convert('L')) < 128, np.uint8)
+        scale = psegutils.estimate_scale(binary)
+        with mock.patch.object(common, 'STRIPS_MINSIZE', binary.size):
+            start = perf_counter()
+            expected = compute(binary, scale)
+            old = perf_counter() - start
+        with mock.patch.object(common, 'STRIPS_MINSIZE', 0), \
+             mock.patch.object(common, 'STRIPS_THREADS', jobs), \
+             mock.patch.object(common, 'available_cpus', return_value=jobs):
+            start = perf_counter()
+            actual = compute(binary, scale)
+            new = perf_counter() - start
+        identical = all(np.array_equal(a, b) for a, b in zip(expected, actual))
+        click.echo(f"{path}: identical: {identical}, whole page: {old:.2f}s, "
+                   f"{jobs} strips: {new:.2f}s, speedup: {old / new:.2f}")
+
+
+if __name__ == '__main__':
+    benchmark()
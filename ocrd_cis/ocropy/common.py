@@ -1,12 +1,16 @@
 from __future__ import absolute_import
 from typing import Optional
 
+import os
 import warnings
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from scipy.ndimage import measurements, filters, interpolation, morphology
 from scipy import stats, signal
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 #from skimage.morphology import convex_hull_image
 from skimage.morphology import medial_axis
 import networkx as nx
@@ -67,6 +71,38 @@ def array2pil(array):
     array = np.array(255.0 * array, np.uint8)
     return ocrolib.array2pil(array)
 
+def downscale_binary(binary, size, threshold=0.5):
+    """Reduce a binarized image to a lower pixel density.
+
+    Given a binarized, inverted image as Numpy array ``binary``
+    (with 0 for white and 1 for black), and a smaller target
+    ``size`` (as width, height), average the foreground over
+    the area each target pixel covers in the source, and
+    binarize again by requiring a coverage larger than
+    ``threshold``.
+
+    (Other than subsampling, this does not lose or alias
+    thin strokes and gaps.)
+
+    Returns a boolean array of shape height, width.
+    """
+    image = Image.fromarray(np.array(binary, np.uint8) * 255)
+    image = image.resize(size, Image.BOX)
+    return np.array(image) > 255 * threshold
+
+def upscale_labels(labels, shape):
+    """Enlarge a label (or mask) array to a higher pixel density.
+
+    Given a Numpy array ``labels`` of any type, and a larger
+    target ``shape``, look up the source pixel covering the
+    center of each target pixel (i.e. nearest neighbour).
+
+    Returns an array of shape ``shape`` and the same type.
+    """
+    rows = np.array((np.arange(shape[0]) + 0.5) * labels.shape[0] / shape[0], int)
+    cols = np.array((np.arange(shape[1]) + 0.5) * labels.shape[1] / shape[1], int)
+    return labels[np.ix_(rows, cols)]
+
 # from ocropy-nlbin, but keeping exact size
 @checks(GRAYSCALE1)
 def estimate_local_whitelevel(image, zoom=0.5, perc=80, range_=20):
@@ -300,13 +336,15 @@ def borderclean_bin(binary, margin=4):
     return (1 - binary)*(1 - mask)
 
 # from ocropus-rpred, but with zoom parameter
-def check_line(binary, zoom=1.0):
+def check_line(binary, zoom=1.0, maxwidth=4000):
     """Validate binary as a plausible text line image.
 
     Given a binarized, inverted image as Numpy array `binary`
     (with 0 for white and 1 for black),
     check the array has the right dimensions, is in fact inverted,
     and does not have too few or too many connected black components.
+    (Lines wider than `maxwidth` pixels at `zoom` are rejected,
+    unless `maxwidth` is None.)
 
     Returns an error report, or None if valid.
     """
@@ -319,7 +357,7 @@ def check_line(binary, zoom=1.0):
     if h>200/zoom: return "image too tall for a text line %s"%(binary.shape,)
     ##if w<1.5*h: return "line too short %s"%(binary.shape,)
     if w<1.5*h and w<32/zoom: return "image too short for a line image %s"%(binary.shape,)
-    if w>4000/zoom: return "image too long for a line image %s"%(binary.shape,)
+    if maxwidth and w>maxwidth/zoom: return "image too long for a line image %s"%(binary.shape,)
     return None
     ratio = w*1.0/h
     _, ncomps = measurements.label(binary)
@@ -389,6 +427,55 @@ def check_page(binary, zoom=1.0):
 def odd(num):
     return int(num) + int((num+1)%2)
 
+# arrays larger than this (in pixels) get filtered in parallel strips
+STRIPS_MINSIZE = 4000000
+# maximum number of threads (and strips) to filter in; by default 1,
+# i.e. filter the whole page (as several pages may run in parallel)
+STRIPS_THREADS = int(os.getenv("OCROPY_STRIPS_THREADS") or "1")
+
+def available_cpus():
+    """Number of CPUs this process may run on (respecting its affinity)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def filter_strips(function, *arrays, halo=0, axis=0):
+    """Apply neighbourhood filters to large arrays in parallel strips.
+
+    Given a ``function`` of same-shape 2D Numpy ``arrays``, which only
+    combines neighbourhood filters (like ``gaussian_filter`` or
+    ``maximum_filter``) and pixel-wise operations, return its result
+    (of the same shape).
+
+    If the arrays have more than ``STRIPS_MINSIZE`` pixels and
+    ``STRIPS_THREADS`` (set by the environment variable ``OCROPY_STRIPS_THREADS``)
+    allows multiple threads on the available CPUs, then split them
+    into that many strips along ``axis`` (i.e. into
+    horizontal strips for 0), each extended by ``halo`` pixels of
+    context on both sides, call ``function`` on those in a thread pool
+    (SciPy releases the GIL while filtering), and stitch the results
+    together (without the extensions).
+
+    This is exact if ``halo`` covers the combined radius of all filters
+    along ``axis``. (Filters which accumulate along ``axis``, like
+    ``uniform_filter``, would still differ by rounding, so split those
+    along the other axis instead.)
+    """
+    size = arrays[0].shape[axis]
+    nstrips = min(STRIPS_THREADS, available_cpus(), size // max(1, halo))
+    if arrays[0].size <= STRIPS_MINSIZE or nstrips < 2:
+        return function(*arrays)
+    bounds = np.linspace(0, size, nstrips + 1).astype(int)
+    def strip(start, stop):
+        index = [slice(None)] * arrays[0].ndim
+        first = max(0, start - halo)
+        index[axis] = slice(first, min(size, stop + halo))
+        result = function(*[array[tuple(index)] for array in arrays])
+        index[axis] = slice(start - first, stop - first)
+        return result[tuple(index)]
+    with ThreadPoolExecutor(max_workers=nstrips) as pool:
+        return np.concatenate(list(pool.map(strip, bounds[:-1], bounds[1:])), axis=axis)
+
 # from ocropus-gpageseg, but with interactive switch
 @disabled()
 def DSAVE(title,array, interactive=False):
@@ -514,6 +601,26 @@ def compute_images(binary, scale, maximages=5):
     # we could repeat reconstruct-dilate here...
     return images
 
+def label_distances(labels, nlabels, dist):
+    """Get the size, and the median and standard deviation of ``dist``
+    for all labels 1 to ``nlabels`` in ``labels`` at once.
+
+    Returns three arrays indexed by label-1.
+    """
+    pixels = np.flatnonzero(labels)
+    pixellabels = labels.flat[pixels] - 1
+    distances = dist.flat[pixels]
+    sizes = np.bincount(pixellabels, minlength=nlabels)
+    # median: the middle one(s) of each label in the sorted distances
+    distances_sorted = distances[np.lexsort((distances, pixellabels))]
+    starts = np.cumsum(sizes) - sizes
+    medians = (distances_sorted[starts + (sizes - 1) // 2] +
+               distances_sorted[starts + sizes // 2]) / 2
+    means = np.bincount(pixellabels, distances, minlength=nlabels) / sizes
+    stds = np.sqrt(np.bincount(pixellabels, (distances - means[pixellabels]) ** 2,
+                               minlength=nlabels) / sizes)
+    return sizes, medians, stds
+
 @checks(ABINARY2,NUMBER)
 def compute_seplines(binary, scale, maxseps=0):
     """Detects thin connected foreground components that could be separators.
@@ -536,6 +643,7 @@ def compute_seplines(binary, scale, maxseps=0):
     # - line-like glyphs (i.e. false positives)
     if maxseps == 0:
         return np.zeros_like(binary, int)
+    binary = np.array(binary, bool) # (for masking below)
     skel, dist = medial_axis(binary, return_distance=True)
     DSAVE("medial-axis", [dist, skel])
     labels, nlabels = morph.label(skel)
@@ -543,30 +651,28 @@ def compute_seplines(binary, scale, maxseps=0):
     DSAVE("skel-labels", labels)
     # determine those components which could be separators
     # (filter by compactness, and by mean+variance of distances)
+    # (sizes are sums of skel pixels, i.e. "inner length")
+    labelsizes, avg_dists, std_dists = label_distances(labels, nlabels, dist)
+    labeldims = np.array([sl.dims(labelslice) for labelslice in slices[1:]]).reshape(-1, 2)
+    labelaspects = labeldims[:, 0] / labeldims[:, 1]
+    labelaspects = np.where(labelaspects > 1, 1 / labelaspects, labelaspects)
+    labellengths = np.hypot(labeldims[:, 0], labeldims[:, 1]) # length of bbox diagonal, i.e. "outer length"
+    # not long / straight, but very compact
+    compact = ((labelsizes > 1.5 * labellengths) &
+               (labelaspects >= 0.1) &
+               (labelsizes < 15 * scale)) #& (labelsizes > 0.1 * labelarea)
+    # todo: empirical analysis of ideal thresholds
+    candidates = ~compact & ~(avg_dists > scale / 4) & ~(std_dists / avg_dists > 0.7)
     sepmap = np.zeros(nlabels + 1, int)
     numsep = 0
     sepsizes = [0]
     sepslices = [None]
     sepdists = [0]
-    for label in range(1, nlabels + 1):
+    for label in np.flatnonzero(candidates) + 1:
         labelslice = slices[label]
-        labelmask = labels == label
-        labelsize = np.count_nonzero(labelmask) # sum of skel pixels, i.e. "inner length"
-        labelarea = sl.area(labelslice)
-        labelaspect = sl.aspect(labelslice)
-        if labelaspect > 1:
-            labelaspect = 1 / labelaspect
-        labellength = np.hypot(*sl.dims(labelslice)) # length of bbox diagonal, i.e. "outer length"
-        #LOG.debug("skel label %d has inner size %d and outer size %d", label, labelsize, labellength)
-        if labelsize > 1.5 * labellength and labelaspect >= 0.1 and labelsize < 15 * scale: #and labelsize > 0.1 * labelarea
-            # not long / straight, but very compact
-            continue
-        distances = dist[labelmask]
-        avg_dist = np.median(distances) #np.mean(distances)
-        std_dist = np.std(distances)
-        # todo: empirical analysis of ideal thresholds
-        if avg_dist > scale / 4 or std_dist/avg_dist > 0.7:
-            continue
+        labelsize = labelsizes[label - 1]
+        avg_dist = avg_dists[label - 1]
+        std_dist = std_dists[label - 1]
         #LOG.debug("skel label %d has dist %.1f±%.2f", label, avg_dist, std_dist)
         numsep += 1
         sepmap[label] = numsep
@@ -576,6 +682,9 @@ def compute_seplines(binary, scale, maxseps=0):
         if labelsize > 10 * scale and avg_dist > 0 and std_dist / avg_dist > 0.2:
             # try to split this large label up along neighbouring spans of similar distances:
             # (e.g. vlines that touch letters or images)
+            # (only within the bounding box of the label)
+            labelmask = labels[labelslice] == label
+            distances = dist[labelslice][labelmask]
             # 1. get optimal (by variability) spans as bin intervals, then merge largest spans
             disthist, distedges = np.histogram(distances, bins='scott', density=True) # stone
             disthist *= np.diff(distedges) # get probability masses
@@ -587,37 +696,33 @@ def compute_seplines(binary, scale, maxseps=0):
             disthist = np.cumsum(disthist)[disthistlarge]
             disthist = np.diff(disthist, prepend=0)
             distbin = np.digitize(distances, distedges, right=True)
-            # 2. now find connected components within bins, but map all tiny components
-            #    to a single label so they can be replaced by their neighbours later-on
-            sublabels = np.zeros_like(labels)
-            sublabels[labelmask] = distbin + 1
-            DSAVE("sublabels", sublabels)
-            sublabels2 = np.zeros_like(labels)
-            sublabel = 1
-            sublabelmap = [0, 1]
-            for bin in range(len(distedges)):
-                binmask = sublabels == bin + 1
-                binlabels, nbinlabels = morph.label(binmask)
-                _, binlabelcounts = np.unique(binlabels, return_counts=True)
-                largemask = (binlabelcounts > 2 * scale)[binlabels]
-                smallmask = (binlabelcounts <= 2 * scale)[binlabels]
-                sublabels2[binmask & smallmask] = 1
-                if not np.any(binmask & largemask):
-                    continue
-                sublabels2[binmask & largemask] = binlabels[binmask & largemask] + sublabel
-                sublabel += nbinlabels
-                sublabelmap.extend(nbinlabels*[bin + 1])
-            if sublabel == 1:
+            # 2. now find connected components within bins (as graph of neighbouring
+            #    skeleton pixels), but mark all tiny components
+            #    so they can be replaced by their neighbours later-on
+            width = labelmask.shape[1]
+            pixels = np.flatnonzero(labelmask)
+            columns = pixels % width
+            edges = []
+            for offset, valid in [(1, columns < width - 1),
+                                  (width - 1, columns > 0),
+                                  (width, True),
+                                  (width + 1, columns < width - 1)]:
+                neighbours = np.minimum(np.searchsorted(pixels, pixels + offset), len(pixels) - 1)
+                valid = valid & (pixels[neighbours] == pixels + offset) & (distbin[neighbours] == distbin)
+                edges.append(np.stack([np.flatnonzero(valid), neighbours[valid]]))
+            edges = np.concatenate(edges, axis=1)
+            graph = coo_matrix((np.ones(edges.shape[1]), edges), shape=(len(pixels), len(pixels)))
+            _, components = connected_components(graph, directed=False)
+            small = (np.bincount(components) <= 2 * scale)[components]
+            if np.all(small):
                 continue # only tiny sublabels here
-            DSAVE("sublabels_connected", sublabels2)
-            sublabelmap = np.array(sublabelmap)
-            # 3. finally, replace tiny components by nearest components,
-            #    and recombine survivors to bin labels
-            smallmask = sublabels2 == 1
-            sublabels2[smallmask] = 0
-            sublabels2[smallmask] = morph.spread_labels(sublabels2)[smallmask]
-            sublabels = sublabelmap[sublabels2]
+            # 3. finally, replace tiny components by nearest components
+            sublabels = np.zeros(labelmask.shape, int)
+            sublabels.flat[pixels[~small]] = distbin[~small] + 1
+            if np.any(small):
+                sublabels.flat[pixels[small]] = morph.spread_labels(sublabels).flat[pixels[small]]
             DSAVE("sublabels_final", sublabels)
+            sublabels = sublabels.flat[pixels]
             # now apply as multiple separators
             numsep -= 1
             sepmap[label] = 0
@@ -625,26 +730,30 @@ def compute_seplines(binary, scale, maxseps=0):
             sepsizes = sepsizes[:-1]
             sepslices = sepslices[:-1]
             sepdists = sepdists[:-1]
-            for sublabel in np.unique(sublabels[labelmask]):
+            y0, x0 = sl.start(labelslice)
+            for sublabel in np.unique(sublabels):
                 sublabelmask = sublabels == sublabel
-                sublabelsize = np.count_nonzero(sublabelmask)
-                sublabelslice = sublabelmask.nonzero()
-                sublabelslice = sl.box(sublabelslice[0].min(),
-                                       sublabelslice[0].max(),
-                                       sublabelslice[1].min(),
-                                       sublabelslice[1].max())
-                subdistances = dist[sublabelmask]
+                sublabelys, sublabelxs = np.divmod(pixels[sublabelmask], width)
+                sublabelsize = len(sublabelys)
+                sublabelslice = sl.box(sublabelys.min() + y0,
+                                       sublabelys.max() + y0,
+                                       sublabelxs.min() + x0,
+                                       sublabelxs.max() + x0)
+                subdistances = distances[sublabelmask]
                 nlabels += 1
                 numsep += 1
                 sepmap = np.append(sepmap, numsep)
-                labels[sublabelmask] = nlabels
+                labels[labelslice][sublabelys, sublabelxs] = nlabels
                 slices.append(sublabelslice)
                 sepsizes.append(sublabelsize)
                 sepslices.append(sublabelslice)
                 sepdists.append(np.median(subdistances))
                 #LOG.debug("adding sublabel %d as sep %d (size %d [%s])", sublabel, numsep, sublabelsize, str(sublabelslice))
     sepsizes = np.array(sepsizes)
-    sepslices = np.array(sepslices)
+    # object array of slice tuples (np.array would try to nest them)
+    slicelist, sepslices = sepslices, np.empty(len(sepslices), object)
+    for i, sepslice in enumerate(slicelist):
+        sepslices[i] = sepslice
     LOG.debug("detected %d separator candidates", numsep)
     DSAVE("seps-raw", sepmap[labels])
     # now dilate+erode to link neighbouring candidates,
@@ -658,24 +767,28 @@ def compute_seplines(binary, scale, maxseps=0):
     closed = morph.rb_closing(sepmap[labels] > 0, (d0,d1))
     DSAVE("seps-closed", [dist, closed])
     labels2, nlabels2 = morph.label(closed)
-    corrs = morph.correspondences(sepmap[labels], labels2, return_counts=False).T
+    # correspondences between seps and sep2s (on the skeleton only, ignoring bg)
+    seps = sepmap[labels]
+    skelpixels = np.flatnonzero(seps)
+    corrs = np.unique(np.stack([seps.flat[skelpixels], labels2.flat[skelpixels]], axis=1), axis=0)
+    seplabels = np.zeros(numsep + 1, int)
+    seplabels[sepmap] = np.arange(len(sepmap))
     corrmap = np.arange(numsep + 1)
-    for sep2 in range(1, nlabels2 + 1):
-        corrinds = corrs[:, 1] == sep2
-        corrinds[corrs[:, 0] == 0] = False # ignore bg
-        corrinds = corrinds.nonzero()[0]
-        if len(corrinds) == 1:
+    # group by sep2 (keeping the order of the correspondences)
+    corrinds = np.argsort(corrs[:, 1], kind='stable')
+    for corrinds in np.split(corrinds, np.flatnonzero(np.diff(corrs[corrinds, 1])) + 1):
+        if len(corrinds) <= 1:
             continue # nothing to link
         nonoverlapping = np.zeros((len(corrinds), len(corrinds)), dtype=bool)
         for i, indi in enumerate(corrinds[:-1]):
             sepi = corrs[indi, 0]
-            labeli = np.flatnonzero(sepmap == sepi)[0]
+            labeli = seplabels[sepi]
             slicei = slices[labeli]
             lengthi = np.hypot(*sl.dims(slicei))
             areai = sl.area(slicei)
             for j, indj in enumerate(corrinds[i + 1:], i + 1):
                 sepj = corrs[indj, 0]
-                labelj = np.flatnonzero(sepmap == sepj)[0]
+                labelj = seplabels[sepj]
                 slicej = slices[labelj]
                 lengthj = np.hypot(*sl.dims(slicej))
                 areaj = sl.area(slicej)
@@ -900,10 +1013,14 @@ def compute_colseps_conv(binary, scale=1.0, csminheight=10, maxcolseps=2):
         return binary == -1
     LOG.debug("considering at most %g whitespace column separators", maxcolseps)
     # find vertical whitespace by thresholding
-    smoothed = filters.gaussian_filter(1.0*binary,(scale,scale*0.5))
+    # (on large pages, filter in parallel strips, with a halo of the Gaussian radius,
+    #  or along the other axis for vertical uniform filters)
+    smoothed = filter_strips(lambda binary: filters.gaussian_filter(1.0*binary,(scale,scale*0.5)),
+                             binary, halo=int(4*scale+0.5))
     #smoothed = filters.uniform_filter(smoothed,(5.0*scale,1))
     # avoid blurring small/protruding glyphs below threshold
-    smoothed = np.maximum(smoothed, filters.uniform_filter(smoothed,(5.0*scale,1)))
+    smoothed = np.maximum(smoothed, filter_strips(lambda smoothed: filters.uniform_filter(smoothed,(5.0*scale,1)),
+                                                  smoothed, axis=1))
     thresh = (smoothed<np.amax(smoothed)*0.1)
     # note: maximum is unreliable
     #thresh = (smoothed<np.median(smoothed)*0.4) # 0.7
@@ -911,13 +1028,16 @@ def compute_colseps_conv(binary, scale=1.0, csminheight=10, maxcolseps=2):
     # maybe best use hist, bins = np.histogram(smoothed); bins[scipy.signal.find_peaks(-hist)[0]]
     DSAVE("colwsseps1_thresh",thresh+binary*0.6)
     # find column edges by filtering
-    grad = filters.gaussian_filter(1.0*binary,(scale,scale*0.5),order=(0,1))
-    grad = filters.uniform_filter(grad,(10.0*scale,1)) # csminheight
+    grad = filter_strips(lambda binary: filters.gaussian_filter(1.0*binary,(scale,scale*0.5),order=(0,1)),
+                         binary, halo=int(4*scale+0.5))
+    grad = filter_strips(lambda grad: filters.uniform_filter(grad,(10.0*scale,1)), # csminheight
+                         grad, axis=1)
     DSAVE("colwsseps2_grad-raw",grad)
     grad = grad > np.minimum(0.5 * np.amax(grad), np.percentile(grad, 99.5))
     DSAVE("colwsseps2_grad",grad)
     # combine dilated edges and whitespace
-    seps = np.minimum(thresh,filters.maximum_filter(grad,(odd(10*scale),odd(5*scale))))
+    seps = filter_strips(lambda thresh, grad: np.minimum(thresh,filters.maximum_filter(grad,(odd(10*scale),odd(5*scale)))),
+                         thresh, grad, halo=odd(10*scale)//2)
     DSAVE("colwsseps3_seps",seps+binary*0.6)
     # select only the biggest column separators
     seps = morph.select_regions(seps,sl.dim0,min=csminheight*scale,nbest=maxcolseps)
@@ -986,31 +1106,99 @@ def compute_gradmaps(binary, scale,
     cleaned = boxmap*binary
     DSAVE("boxmap-cleaned",cleaned)
     # find vertical edges
-    if usegauss:
-        # this uses Gaussians
-        grad = filters.gaussian_filter(
-            1.0*cleaned,
-            (vscale*0.3*scale,
-             hscale*scale),
-            #hscale*6*scale),
-            order=(1,0))
-    else:
+    def vgrad(cleaned):
+        if usegauss:
+            # this uses Gaussians
+            return filters.gaussian_filter(
+                1.0*cleaned,
+                (vscale*0.3*scale,
+                 hscale*scale),
+                #hscale*6*scale),
+                order=(1,0))
         # this uses non-Gaussian oriented filters
         grad = filters.gaussian_filter(
             1.0*cleaned,
             (max(4,vscale*0.3*scale),
              hscale*scale),
             order=(1,0))
-        grad = filters.uniform_filter(
+        return filters.uniform_filter(
             grad,
             (vscale,hscale*scale))
             ##(vscale,hscale*6*scale))
+    # (on large pages, filter in parallel strips, with a halo of the filter radii)
+    if usegauss:
+        halo = int(4*vscale*0.3*scale+0.5)
+    else:
+        halo = int(4*max(4,vscale*0.3*scale)+0.5) + int(vscale)//2
+    grad = filter_strips(vgrad, cleaned, halo=halo)
     DSAVE("gradmap", grad)
     bottom = ocrolib.norm_max((grad<0)*(-grad))
     top = ocrolib.norm_max((grad>0)*grad)
     DSAVE("bottom+top+boxmap", [0.5*boxmap + 0.5*binary, bottom, top])
     return bottom,top,boxmap
 
+def mark_line_seeds(bmarked, tmarked, scale, robust=True):
+    """Mark the regions between bottom and top marks as line seeds.
+
+    In each column, go through the marks from bottom to top (bottom
+    before top marks on the same pixel), and project seeds from them:
+    In robust mode, project up from bottom and down from top marks,
+    but only as far as the next mark. Otherwise, project up from bottom
+    marks, and fill up to the next mark if that is a close top mark.
+
+    All columns are processed at once: the marks get sorted by column
+    and inverse position, and their intervals painted in one go."""
+    h, w = bmarked.shape
+    delta = max(3,int(scale))
+    bmarks = np.flatnonzero(bmarked)
+    tmarks = np.flatnonzero(tmarked)
+    kinds = np.repeat([0, 1], [len(bmarks), len(tmarks)])
+    ys, xs = np.divmod(np.concatenate([bmarks, tmarks]), w)
+    # sort by x, then inverse y, then kind of mark (bottom=0 before top=1):
+    order = np.argsort((xs * h + h - 1 - ys) * 2 + kinds)
+    xs, ys, kinds = xs[order], ys[order], kinds[order]
+    bottom = kinds == 0
+    # previous (lower) and next (upper) mark in the same column:
+    first = np.ones(len(xs), bool)
+    first[1:] = xs[1:] != xs[:-1]
+    last = np.ones(len(xs), bool)
+    last[:-1] = first[1:]
+    ys_prev = np.zeros_like(ys)
+    ys_prev[1:] = ys[:-1]
+    ys_next = np.zeros_like(ys)
+    ys_next[:-1] = ys[1:]
+    if robust:
+        # project seed from bottom, but fill only to next mark
+        y1 = np.maximum(0, ys - delta)
+        y1 = np.where(~last & (ys_next > y1), ys_next, y1)
+        # project seed from top, but fill only to previous mark
+        y2 = ys + delta
+        y2 = np.where(~first & (ys_prev < y2), ys_prev, y2)
+        starts = np.where(bottom, y1, ys)
+        stops = np.where(bottom, ys, y2)
+        columns = xs
+    else:
+        # after the last mark of a column, assume a top mark at 0
+        ys_next[last] = 0
+        top_next = np.ones(len(xs), bool)
+        top_next[:-1] = ~bottom[1:]
+        top_next[last] = True
+        # project seed from bottom (negative starts as in slicing)
+        y1 = ys - delta
+        y1 = np.where(y1 < 0, np.maximum(0, y1 + h), y1)
+        # consistent next top? fill with seed completely
+        fill = bottom & top_next & (ys - ys_next < 5*scale) # why 5?
+        starts = np.concatenate([y1[bottom], ys_next[fill]])
+        stops = np.concatenate([ys[bottom], ys[fill]])
+        columns = np.concatenate([xs[bottom], xs[fill]])
+    stops = np.minimum(stops, h)
+    lengths = np.maximum(0, stops - starts)
+    # enumerate all pixels of all intervals
+    offsets = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    seeds = np.zeros((h, w), 'i')
+    seeds[np.repeat(starts, lengths) + offsets, np.repeat(columns, lengths)] = 1
+    return seeds
+
 # from ocropus-gpageseg, but
 # - with robust mode (can be disabled):
 #   improved state transitions between bottom and top marks,
@@ -1031,53 +1219,25 @@ def compute_line_seeds(binary,bottom,top,colseps,scale,
     vrange = odd(vscale*scale)
     # find (more or less) horizontal lines along the maximum gradient,
     # where it is above (squared) threshold and not crossing columns:
-    bmarked = filters.maximum_filter(
-        # mark position of maximum gradient every `vrange` pixels:
-        bottom==filters.maximum_filter(bottom,(vrange,0)),
-        # blur by 2 pixels, then retain only large gradients:
-        (2,2)) * (bottom>threshold*np.amax(bottom)*threshold) *(1-colseps)
-    tmarked = filters.maximum_filter(
-        # mark position of maximum gradient every `vrange` pixels:
-        top==filters.maximum_filter(top,(vrange,0)),
-        # blur by 2 pixels, then retain only large gradients:
-        (2,2)) * (top>threshold*np.amax(top)*threshold/2) *(1-colseps)
-    if robust:
-        bmarked = filters.maximum_filter(bmarked,(1,odd(scale))) *(1-colseps)
-    tmarked = filters.maximum_filter(tmarked,(1,odd(scale))) *(1-colseps)
+    def mark(grad, colseps, gradmin, hdilate):
+        marked = filters.maximum_filter(
+            # mark position of maximum gradient every `vrange` pixels:
+            grad==filters.maximum_filter(grad,(vrange,0)),
+            # blur by 2 pixels, then retain only large gradients:
+            (2,2)) * (grad>gradmin) *(1-colseps)
+        if hdilate:
+            marked = filters.maximum_filter(marked,(1,odd(scale))) *(1-colseps)
+        return marked
+    # (on large pages, filter in parallel strips, with a halo of the filter radii)
+    bmin = threshold*np.amax(bottom)*threshold
+    tmin = threshold*np.amax(top)*threshold/2
+    bmarked = filter_strips(lambda bottom, colseps: mark(bottom, colseps, bmin, robust),
+                            bottom, colseps, halo=vrange//2+1)
+    tmarked = filter_strips(lambda top, colseps: mark(top, colseps, tmin, True),
+                            top, colseps, halo=vrange//2+1)
     ##tmarked = filters.maximum_filter(tmarked,(1,20))
     # why not just np.diff(bmarked-tmarked, axis=0, append=0) > 0 ?
-    seeds = np.zeros(binary.shape,'i')
-    delta = max(3,int(scale))
-    for x in range(bmarked.shape[1]):
-        # sort both kinds of mark from bottom to top (i.e. inverse y position)
-        transitions = sorted([(y,1) for y in psegutils.find(bmarked[:,x])] +
-                             [(y,0) for y in psegutils.find(tmarked[:,x])])[::-1]
-        if robust:
-            l = 0
-            while l < len(transitions):
-                y0, s0 = transitions[l]
-                if s0: # bmarked?
-                    y1 = max(0, y0 - delta) # project seed from bottom
-                    if l+1 < len(transitions) and transitions[l+1][0] > y1:
-                        y1 = transitions[l+1][0] # fill with seed to next mark
-                    seeds[y1:y0, x] = 1
-                else: # tmarked?
-                    y1 = y0 + delta # project seed from top
-                    if l > 0 and transitions[l-1][0] < y1:
-                        y1 = transitions[l-1][0] # fill with seed to next mark
-                    seeds[y0:y1, x] = 1
-                l += 1
-        else:
-            transitions += [(0,0)]
-            for l in range(len(transitions)-1):
-                y0,s0 = transitions[l]
-                if s0==0:
-                    continue # keep looking for next bottom
-                seeds[y0-delta:y0,x] = 1 # project seed from bottom
-                y1,s1 = transitions[l+1]
-                if s1==0 and (y0-y1)<5*scale: # why 5?
-                    # consistent next top?
-                    seeds[y1:y0,x] = 1 # fill with seed completely
+    seeds = mark_line_seeds(bmarked, tmarked, scale, robust=robust)
     DSAVE("lineseeds+bmarked+tmarked",[0.4*seeds+0.6*binary, bmarked, tmarked])
     if robust:
         # try to separate lines that already touch:
@@ -1102,16 +1262,30 @@ def hmerge_line_seeds(binary, seeds, scale, threshold=0.8, seps=None):
     # (ensuring contiguous contours), but
     # ignore conflicts which affect only small fractions of either line
     # (avoiding merges for small vertical overlap):
-    labels = np.unique(seeds * (binary > 0)) # without empty foreground
+    fg_y, fg_x = np.nonzero(binary)
+    fg_labels = seeds[fg_y, fg_x]
+    labels = np.flatnonzero(np.bincount(fg_labels)).astype(seeds.dtype) # without empty foreground
     labels = labels[labels > 0] # without background
     seeds[~np.isin(seeds, labels, assume_unique=True)] = 0
     #DSAVE("hmerge0_nonempty", seeds)
     if len(labels) < 2:
         return seeds
     objects = measurements.find_objects(seeds)
-    centers = measurements.center_of_mass(binary, seeds, labels)
+    # center of mass (same as measurements.center_of_mass, but only summing fg)
+    fg_weights = binary[fg_y, fg_x]
+    centers = np.stack([np.bincount(fg_labels, fg_weights * fg_y)[labels],
+                        np.bincount(fg_labels, fg_weights * fg_x)[labels]], axis=1)
+    centers /= np.bincount(fg_labels, fg_weights)[labels, np.newaxis]
     relabel = np.arange(np.max(seeds)+1, dtype=seeds.dtype)
-    # FIXME: get incidence of y overlaps to avoid full inner loops
+    # current bounding boxes (seeds get extended by filling gaps)
+    boxes = {label: [objects[label-1][0].start, objects[label-1][0].stop,
+                     objects[label-1][1].start, objects[label-1][1].stop]
+             for label in labels}
+    # index of y intervals (sorted by start) to find overlap candidates
+    ystarts = np.array([objects[label-1][0].start for label in labels])
+    ystops = np.array([objects[label-1][0].stop for label in labels])
+    byystart = np.argsort(ystarts, kind='stable')
+    ystarts_sorted = ystarts[byystart]
     LOG.debug('checking %d non-empty line seeds for overlaps', len(labels))
     def h_compatible(obj1, obj2, center1, center2):
         if not (obj2[0].start < center1[0] < obj2[0].stop):
@@ -1123,34 +1297,45 @@ def hmerge_line_seeds(binary, seeds, scale, threshold=0.8, seps=None):
         if (obj1[1].start < center2[1] < obj1[1].stop):
             return False
         return True
+    def row_extents(label):
+        # rows of label, with their first and last x and their pixel count
+        y0, y1, x0, x1 = boxes[label]
+        seed = seeds[y0:y1, x0:x1] == label
+        counts = np.count_nonzero(seed, axis=1)
+        rows = np.flatnonzero(counts)
+        seed = seed[rows]
+        xmin = np.argmax(seed, axis=1) + x0
+        xmax = x1 - 1 - np.argmax(seed[:, ::-1], axis=1)
+        return rows + y0, xmin, xmax, counts[rows]
+    margin = 2 * int(scale) + 2
+    height, width = seeds.shape
     for label in labels:
-        seed = seeds == label
+        y0, y1, x0, x1 = boxes[label]
+        y0, x0 = max(0, y0 - margin), max(0, x0 - margin)
+        y1, x1 = min(height, y1 + margin), min(width, x1 + margin)
+        seed = seeds[y0:y1, x0:x1] == label
         if not seed.any():
             continue
         #DSAVE('hmerge1_seed', seed)
         # close to fill holes from underestimated scale
+        # (within the box, plus margin for the structuring element)
         seed = morph.rb_closing(seed, (scale, scale))
         #DSAVE('hmerge2_closed', seed)
         # not really necessary (seed does not contain ascenders/descenders):
         # # open horizontally to remove extruding ascenders/descenders
         # seed = morph.rb_opening(seed, (1, 3*scale))
         # DSAVE('hmerge3_h-opened', seed)
-        if not seed.any():
-            continue
-        obj = measurements.find_objects(seed)[0]
-        if obj is None:
+        rows = np.flatnonzero(seed.any(axis=1))
+        if not len(rows):
             continue
-        seed[obj[0], 0:seed.shape[1]] = 1
-        #DSAVE('hmerge4_h-closed', seed)
-        # get overlaps
-        for label2 in labels:
+        # the closed seed, extended horizontally over the full width
+        obj = slice(rows[0] + y0, rows[-1] + 1 + y0)
+        # get overlaps (only among seeds with y-overlapping boxes)
+        candidates = byystart[:np.searchsorted(ystarts_sorted, obj.stop, side='right')]
+        candidates = np.sort(candidates[ystops[candidates] >= obj.start])
+        for label2 in labels[candidates]:
             if label == label2 or relabel[label] == label2:
                 continue
-            obj2 = objects[label2-1]
-            if not obj2:
-                continue
-            if not sl.yoverlaps(obj, obj2):
-                continue
             center = centers[labels.searchsorted(label)]
             bbox = objects[label-1]
             if not all(h_compatible(bbox, bbox2, center, center2)
@@ -1158,43 +1343,48 @@ def hmerge_line_seeds(binary, seeds, scale, threshold=0.8, seps=None):
                                               for i in np.nonzero(relabel == relabel[label2])[0]]):
                 LOG.debug('ignoring h-overlap between %d and %d (not mutually centric)', label, label2)
                 continue
-            seed2 = seeds == label2
-            count = np.count_nonzero(seed2 * seed)
-            total = np.count_nonzero(seed2)
+            label2_y, can_x_min, can_x_max, label2_n = row_extents(label2)
+            count = np.sum(label2_n[(label2_y >= obj.start) & (label2_y < obj.stop)])
+            total = np.sum(label2_n)
             if count < threshold * total:
                 LOG.debug('ignoring h-overlap between %d and %d (only %d of %d)', label, label2, count, total)
                 continue
-            label1_y, label1_x = np.where(seeds == label)
-            label2_y, label2_x = np.where(seed2)
-            shared_y = np.intersect1d(label1_y, label2_y)
-            gap = np.zeros_like(seed2, bool)
-            for y in shared_y:
-                can_x_min = label2_x[label2_y == y][0]
-                can_x_max = label2_x[label2_y == y][-1]
-                new_x_min = label1_x[label1_y == y][0]
-                new_x_max = label1_x[label1_y == y][-1]
-                if can_x_max < new_x_min:
-                    if (seps is None or
-                        not seps[y, can_x_max:new_x_min].any()):
-                        gap[y, can_x_max:new_x_min] = True
-                if new_x_max < can_x_min:
-                    if (seps is None or
-                        not seps[y, new_x_max:can_x_min].any()):
-                        gap[y, new_x_max:can_x_min] = True
-            if not gap.any() or gap.max(axis=1).sum() / len(shared_y) < 0.1:
+            label1_y, new_x_min, new_x_max, _ = row_extents(label)
+            shared_y, index1, index2 = np.intersect1d(label1_y, label2_y, assume_unique=True,
+                                                      return_indices=True)
+            can_x_min, can_x_max = can_x_min[index2], can_x_max[index2]
+            new_x_min, new_x_max = new_x_min[index1], new_x_max[index1]
+            # gap intervals on the shared rows
+            left = can_x_max < new_x_min
+            gap = left | (new_x_max < can_x_min)
+            gap_start = np.where(left, can_x_max, new_x_max)
+            gap_stop = np.where(left, new_x_min, can_x_min)
+            if seps is not None and gap.any():
+                rowseps = np.zeros((len(shared_y), width + 1), int)
+                np.cumsum(seps[shared_y] > 0, axis=1, out=rowseps[:, 1:])
+                rowindex = np.arange(len(shared_y))
+                gap &= rowseps[rowindex, gap_stop] == rowseps[rowindex, gap_start]
+            if not gap.any() or np.count_nonzero(gap) / len(shared_y) < 0.1:
                 LOG.debug('ignoring h-overlap between %d and %d (blocked by seps)', label, label2)
                 continue
+            gap_y, gap_start, gap_stop = shared_y[gap], gap_start[gap], gap_stop[gap]
             # find y with shortest gap
-            gapwidth = gap.sum(axis=1)
-            gapwidth[gapwidth==0] = seed.shape[1]
+            gapwidth = np.full(height, width)
+            gapwidth[gap_y] = gap_stop - gap_start
             mingap = gapwidth < gapwidth.min() + 4
             # make contiguous
             mingap = mingap.nonzero()[0]
-            gap[0:mingap[0]] = False
-            gap[mingap[-1]:] = False
+            gap = (gap_y >= mingap[0]) & (gap_y < mingap[-1])
             LOG.debug('hmerging %d with %d', label2, label)
             # fill the horizontal background between both regions:
-            seeds[gap] = label
+            for y, start, stop in zip(gap_y[gap], gap_start[gap], gap_stop[gap]):
+                seeds[y, start:stop] = label
+            if gap.any():
+                box = boxes[label]
+                box[0] = min(box[0], gap_y[gap][0])
+                box[1] = max(box[1], gap_y[gap][-1] + 1)
+                box[2] = min(box[2], np.min(gap_start[gap]))
+                box[3] = max(box[3], np.max(gap_stop[gap]))
             # the new label could have been relabelled already:
             new_label = relabel[label]
             # assign candidate to (new assignment for) label:
@@ -0,0 +1,36 @@
+"""Convert Ocropy models between pickled (.pyrnn.gz) and array (.npz) format.
+
+Run e.g. ``python -m ocrd_cis.ocropy.convert fraktur.pyrnn.gz fraktur.npz``.
+"""
+from __future__ import absolute_import
+
+import click
+
+from .ocrolib import load_object, save_object
+
+
+@click.command()
+@click.option('-p', '--precision', type=click.Choice(['float64', 'float32']),
+              help='floating point type to convert the weights to (default: keep)')
+@click.argument('source')
+@click.argument('target')
+def convert(precision, source, target):
+    """Convert the model file SOURCE into TARGET (.npz or .pyrnn[.gz]).
+
+    The .npz format stores the weights, codec and line normalizer
+    uncompressed (without training logs), so the recognizer can
+    memory-map them when loading (sharing them between processes).
+    """
+    network = load_object(source, nofind=1)
+    for x in network.walk():
+        x.postLoad()
+        if precision:
+            x.setPrecision(precision)
+    network.clear_log()
+    for x in network.walk():
+        x.preSave()
+    save_object(target, network)
+
+
+if __name__ == '__main__':
+    convert()
@@ -15,11 +15,14 @@ import inspect
 import glob
 import gzip
 import pickle
+import struct
+import zipfile
 from .exceptions import (BadClassLabel, BadInput, FileNotFound,
                                 OcropusException)
 from numpy import (amax, amin, array, bitwise_and, clip, dtype, mean, minimum,
                    nan, sin, sqrt, zeros, unique, fromstring)
 from scipy.ndimage import morphology, measurements
+import numpy
 import PIL
 
 from . import default
@@ -45,10 +48,10 @@ def normalize_text(s):
     characters."""
     s = str(s)
     s = unicodedata.normalize('NFC',s)
-    s = re.sub(r'\s+(?u)',' ',s)
-    s = re.sub(r'\n(?u)','',s)
-    s = re.sub(r'^\s+(?u)','',s)
-    s = re.sub(r'\s+$(?u)','',s)
+    s = re.sub(r'(?u)\s+',' ',s)
+    s = re.sub(r'(?u)\n','',s)
+    s = re.sub(r'(?u)^\s+','',s)
+    s = re.sub(r'(?u)\s+$','',s)
     for m,r in chars.replacements:
         s = re.sub(str(m),str(r),s)
     return s
@@ -418,6 +421,9 @@ class RegionExtractor:
 ################################################################
 
 def save_object(fname,obj,zip=0):
+    if fname.endswith(".npz"):
+        save_arrays(fname,lstm.network_to_arrays(obj))
+        return
     if zip==0 and fname.endswith(".gz"):
         zip = 1
     if zip>0:
@@ -438,16 +444,21 @@ def unpickle_find_global(mname,cname):
 def load_object(fname,zip=0,nofind=0,verbose=0):
     """Loads an object from disk. By default, this handles zipped files
     and searches in the usual places for OCRopus. It also handles some
-    class names that have changed."""
+    class names that have changed. Recognizers can also be loaded
+    from .npz files (see `load_arrays`), memory-mapping their weights."""
     if not nofind:
         fname = ocropus_find_file(fname)
     if verbose:
         LOG.info("# loading object '%s'", fname)
+    if fname.endswith(".npz"):
+        return lstm.network_from_arrays(load_arrays(fname))
     if zip==0 and fname.endswith(".gz"):
         zip = 1
     # most models will have been pickled with ocrolib at top level
     # we therefore need to add ocrd_cis.ocropy to the search path
-    sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+    path = os.path.dirname(os.path.dirname(__file__))
+    if path not in sys.path:
+        sys.path.append(path)
     if zip>0:
         with gzip.GzipFile(fname,"rb") as stream:
         #with os.popen("gunzip < '%s'"%fname,"rb") as stream:
@@ -460,6 +471,41 @@ def load_object(fname,zip=0,nofind=0,verbose=0):
             #unpickler.find_global = unpickle_find_global
             return unpickler.load()
 
+def save_arrays(fname,arrays):
+    """Save a dict of arrays into an uncompressed .npz file."""
+    numpy.savez(fname,**arrays)
+
+def load_arrays(fname,mmap_mode="c"):
+    """Load a dict of arrays from an .npz file. Arrays stored uncompressed
+    are memory-mapped (with `mmap_mode`, copy-on-write by default)
+    instead of being read, so the data stay in the page cache and
+    can be shared between processes."""
+    arrays = {}
+    with zipfile.ZipFile(fname) as archive, open(fname,"rb") as stream:
+        for info in archive.infolist():
+            name = info.filename
+            if name.endswith(".npy"):
+                name = name[:-4]
+            if info.compress_type==zipfile.ZIP_STORED and mmap_mode:
+                # find the data in the local file header, then parse the .npy header
+                stream.seek(info.header_offset)
+                header = stream.read(30)
+                namelen,extralen = struct.unpack("<HH",header[26:30])
+                stream.seek(info.header_offset+30+namelen+extralen)
+                version = numpy.lib.format.read_magic(stream)
+                if version==(1,0):
+                    shape,fortran,dtype = numpy.lib.format.read_array_header_1_0(stream)
+                else:
+                    shape,fortran,dtype = numpy.lib.format.read_array_header_2_0(stream)
+                if len(shape)>0 and numpy.prod(shape)>0 and not dtype.hasobject:
+                    arrays[name] = numpy.asarray(numpy.memmap(
+                        fname,dtype=dtype,mode=mmap_mode,offset=stream.tell(),
+                        shape=shape,order="F" if fortran else "C"))
+                    continue
+            with archive.open(info) as member:
+                arrays[name] = numpy.lib.format.read_array(member,allow_pickle=False)
+    return arrays
+
 
 
 ################################################################
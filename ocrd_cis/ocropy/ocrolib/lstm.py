@@ -27,10 +27,11 @@
 
 
 from collections import defaultdict
-import unicodedata, sys
+import unicodedata, sys, os, copy
 
 import numpy as np
-from scipy.ndimage import measurements,filters
+from scipy.ndimage import filters
+from scipy.special import expit
 
 from . import common as ocrolib
 from .toplevel import LOG
@@ -40,6 +41,10 @@ from . import utils
 
 initial_range = 0.1
 
+# reset all rows of the LSTM state variables to NaN before each forward
+# propagation (instead of just the rows used), to catch stale reads
+debug_reset = int(os.getenv("debug_reset") or "0")
+
 def prepare_line(line,pad=16):
     """Prepare a line for recognition; this inverts it, transposes
     it, and pads it."""
@@ -111,6 +116,13 @@ class Network:
         """Prediction is the same as forward propagation."""
         return self.forward(xs)
 
+    def predictChunked(self,xs,chunk,overlap):
+        """Predict on a sequence in windows of (at most) `chunk` time steps
+        (plus `overlap` steps of context for recurrent networks running
+        backwards), so the internal state stays bounded for arbitrarily
+        long sequences. Networks without recurrence simply `predict`."""
+        return self.predict(xs)
+
     def train(self,xs,ys,debug=0):
         """Training performs forward propagation, computes the output deltas
         as the difference between the predicted and desired values,
@@ -126,6 +138,12 @@ class Network:
     def walk(self):
         yield self
 
+    def replicate(self):
+        """Return a copy of the network which shares the weights with
+        this one, but has its own internal state (so both can propagate
+        activations concurrently, e.g. in different threads)."""
+        return copy.copy(self)
+
     def preSave(self):
         pass
 
@@ -193,6 +211,12 @@ class Network:
         since they are updated in place by the `update` method."""
         pass
 
+    def setPrecision(self,dtype):
+        """Convert the weights (and internal state) to floating point
+        type `dtype` (e.g. `np.float32` for faster inference). Composite
+        networks are converted via their components (see `walk`)."""
+        pass
+
     def allweights(self):
         """Return all weights as a single vector. This is mainly a convenience
         function for plotting."""
@@ -223,6 +247,25 @@ class Network:
         """
         raise NotImplementedError
 
+    def forward_batch(self,xs,lengths,train=False):
+        """Propagate activations for a batch of sequences forward through
+        the network. `xs` is a 3D array of shape (time,batch,inputs), with
+        the sequences padded at the end up to the longest one; `lengths`
+        holds their actual lengths. Returns a 3D array of shape
+        (time,batch,outputs); rows beyond the length of a sequence are
+        undefined. With `train`, the internal state is kept for
+        a subsequent call to `backward_batch`.
+        Subclasses should override this; by default, each sequence is
+        propagated individually via `forward` (for inference only)."""
+        if train: raise NotImplementedError
+        result = None
+        for b,l in enumerate(lengths):
+            output = np.array(self.forward(xs[:l,b]))
+            if result is None:
+                result = np.zeros((len(xs),len(lengths),output.shape[1]))
+            result[:l,b] = output
+        return result
+
     def backward(self,deltas):
         """Propagate error signals backward through the network.
         This needs to be implemented in subclasses.
@@ -232,6 +275,14 @@ class Network:
         the `update` method)."""
         raise NotImplementedError
 
+    def backward_batch(self,deltas):
+        """Propagate error signals for a batch of sequences backward through
+        the network, like `backward`, after a call to `forward_batch` with
+        `train`. `deltas` is a 3D array of shape (time,batch,outputs), which
+        must be zero beyond the length of each sequence. The weight deltas
+        are summed over all sequences of the batch."""
+        raise NotImplementedError
+
 class Logreg(Network):
     """A logistic regression layer, a straightforward implementation
     of the logistic regression equations. Uses 1-augmented vectors."""
@@ -270,6 +321,9 @@ class Logreg(Network):
             LOG.info("{} {} {} {}".format(v, a.shape, np.amin(a), np.amax(a)))
     def weights(self):
         yield self.W2,self.DW2,"Logreg"
+    def setPrecision(self,dtype):
+        self.W2 = self.W2.astype(dtype)
+        self.DW2 = self.DW2.astype(dtype)
 
 class Softmax(Network):
     """A softmax layer, a straightforward implementation
@@ -297,6 +351,22 @@ class Softmax(Network):
             zs[i] = temp
         self.state = (inputs,zs)
         return zs
+    def predict(self,ys):
+        """Forward propagate activations for inference only, in one product.
+        This does not update the internal state."""
+        return self.forward_batch(np.asarray(ys,dtype=self.W2.dtype),None)
+    def forward_batch(self,ys,lengths,train=False):
+        """Forward propagate a padded batch of activations in one product.
+        This does not update the internal state (unless `train`)."""
+        if train: self.batch = ys
+        temp = np.dot(ys,self.W2[:,1:].T)
+        temp += self.W2[:,0]
+        temp = np.clip(temp,-100,100)
+        # shift by the maximum to avoid overflows in single precision
+        temp -= np.amax(temp,axis=-1,keepdims=True)
+        temp = np.exp(temp)
+        temp /= np.sum(temp,axis=-1,keepdims=True)
+        return temp
     def backward(self,deltas):
         inputs,zs = self.state
         n = len(zs)
@@ -307,6 +377,15 @@ class Softmax(Network):
             dys[i] = np.dot(dzspre[i],self.W2)[1:]
         self.DW2 = sumouter(dzspre,inputs)
         return dys
+    def backward_batch(self,deltas):
+        ys,self.batch = self.batch,None
+        dys = np.dot(deltas,self.W2[:,1:])
+        # clipped like in sumouter
+        deltas = np.clip(deltas,-1.0,1.0)
+        self.DW2 = np.zeros(self.W2.shape,dtype=self.W2.dtype)
+        self.DW2[:,0] = np.sum(deltas,axis=(0,1))
+        self.DW2[:,1:] = np.tensordot(deltas,ys,axes=([0,1],[0,1]))
+        return dys
     def info(self):
         vars = sorted("W2".split())
         for v in vars:
@@ -314,6 +393,9 @@ class Softmax(Network):
             LOG.info("{} {} {} {}".format(v, a.shape, np.amin(a), np.amax(a)))
     def weights(self):
         yield self.W2,self.DW2,"Softmax"
+    def setPrecision(self,dtype):
+        self.W2 = self.W2.astype(dtype)
+        self.DW2 = self.DW2.astype(dtype)
 
 class MLP(Network):
     """A multilayer perceptron (direct implementation). Effectively,
@@ -417,6 +499,135 @@ def forward_py(n,N,ni,ns,na,xs,source,gix,gfx,gox,cix,gi,gf,go,ci,state,output,W
         output[t] = hfunc(state[t]) * go[t]
     assert not np.isnan(output[:n]).any()
 
+def forward_fused_py(n,ni,ns,na,xs,state,output,WGI,WGF,WGO,WCI,WIP,WFP,WOP,initial=None):
+    """Perform forward propagation of activations for a simple LSTM layer,
+    for inference only. The four gate matrices are stacked, and the
+    contributions of bias and input are computed for all time steps
+    by a single matrix product before the recurrence, so only the
+    product with the previous output remains inside the time loop.
+    Only the states and outputs are kept. To continue a sequence,
+    pass the state and output of its last time step as `initial`."""
+    W = np.vstack([WGI,WGF,WGO,WCI])
+    WR = W[:,1+ni:]
+    WIFP = np.vstack([WIP,WFP])
+    gates = np.dot(xs[:n],W[:,1:1+ni].T)
+    gates += W[:,0]
+    gifx = gates[:,:2*ns].reshape(n,2,ns)
+    gox = gates[:,2*ns:3*ns]
+    cix = gates[:,3*ns:]
+    for t in range(n):
+        prev = (state[t-1],output[t-1]) if t>0 else initial
+        if prev is not None:
+            gates[t] += np.dot(WR,prev[1])
+            gifx[t] += WIFP*prev[0]
+        # input and forget gate at once (same as ffunc, without clipping)
+        gif = expit(gifx[t])
+        np.multiply(gfunc(cix[t]),gif[0],out=state[t])
+        if prev is not None:
+            state[t] += gif[1]*prev[0]
+            gox[t] += WOP*state[t]
+        np.multiply(hfunc(state[t]),expit(gox[t]),out=output[t])
+    assert not np.isnan(output[:n]).any()
+
+def forward_batch_py(n,ni,ns,na,xs,output,WGI,WGF,WGO,WCI,WIP,WFP,WOP):
+    """Perform forward propagation of activations for a simple LSTM layer
+    on a batch of sequences (padded at the end), for inference only.
+    All four gates are computed for the whole batch by a single matrix
+    product per time step, and only the outputs are kept."""
+    B = xs.shape[1]
+    W = np.vstack([WGI,WGF,WGO,WCI])
+    source = np.zeros((B,na),dtype=output.dtype)
+    source[:,0] = 1
+    for t in range(n):
+        source[:,1:1+ni] = xs[t]
+        if t>0:
+            source[:,1+ni:] = output[t-1]
+        gates = np.dot(source,W.T)
+        gix,gfx,gox,cix = gates[:,:ns],gates[:,ns:2*ns],gates[:,2*ns:3*ns],gates[:,3*ns:]
+        if t>0:
+            gix += WIP*state
+            gfx += WFP*state
+        gi = ffunc(gix)
+        gf = ffunc(gfx)
+        ci = gfunc(cix)
+        if t>0:
+            state = ci*gi + gf*state
+            gox += WOP*state
+        else:
+            state = ci*gi
+        go = ffunc(gox)
+        output[t] = hfunc(state) * go
+
+def forward_batch_train_py(n,ni,ns,na,xs,source,gi,gf,go,ci,state,output,WGI,WGF,WGO,WCI,WIP,WFP,WOP):
+    """Perform forward propagation of activations for a simple LSTM layer
+    on a batch of sequences (padded at the end), like `forward_py`, but
+    computing all four gates for the whole batch by a single matrix
+    product per time step. The gate activations are kept for
+    `backward_batch_py` (the arrays have time steps in the first
+    and sequences in the second dimension)."""
+    W = np.vstack([WGI,WGF,WGO,WCI])
+    for t in range(n):
+        source[t,:,0] = 1
+        source[t,:,1:1+ni] = xs[t]
+        if t>0:
+            source[t,:,1+ni:] = output[t-1]
+        gates = np.dot(source[t],W.T)
+        gix,gfx,gox,cix = gates[:,:ns],gates[:,ns:2*ns],gates[:,2*ns:3*ns],gates[:,3*ns:]
+        if t>0:
+            gix += WIP*state[t-1]
+            gfx += WFP*state[t-1]
+        gi[t] = ffunc(gix)
+        gf[t] = ffunc(gfx)
+        ci[t] = gfunc(cix)
+        state[t] = ci[t]*gi[t]
+        if t>0:
+            state[t] += gf[t]*state[t-1]
+            gox += WOP*state[t]
+        go[t] = ffunc(gox)
+        output[t] = hfunc(state[t]) * go[t]
+
+def backward_batch_py(n,ni,ns,na,deltas,
+                      source,gi,gf,go,ci,state,
+                      WGI,WGF,WGO,WCI,WIP,WFP,WOP,
+                      sourceerr,gateerr,stateerr,outerr,
+                      DWGI,DWGF,DWGO,DWCI,DWIP,DWFP,DWOP):
+    """Perform backward propagation of deltas for a simple LSTM layer on
+    a batch of sequences, like `backward_py`, but propagating the errors
+    of all four gates (stacked in `gateerr`, which must be zero initially)
+    for the whole batch by a single matrix product per time step.
+    The weight deltas are summed over all time steps and sequences."""
+    W = np.vstack([WGI,WGF,WGO,WCI])
+    gierr,gferr,goerr,cierr = [gateerr[:,:,k*ns:(k+1)*ns] for k in range(4)]
+    for t in reversed(list(range(n))):
+        outerr[t] = deltas[t]
+        if t<n-1:
+            outerr[t] += sourceerr[t+1][:,-ns:]
+        goerr[t] = fprime(None,go[t]) * hfunc(state[t]) * outerr[t]
+        stateerr[t] = hprime(state[t]) * go[t] * outerr[t]
+        stateerr[t] += goerr[t]*WOP
+        if t<n-1:
+            stateerr[t] += gferr[t+1]*WFP
+            stateerr[t] += gierr[t+1]*WIP
+            stateerr[t] += stateerr[t+1]*gf[t+1]
+        if t>0:
+            gferr[t] = fprime(None,gf[t])*stateerr[t]*state[t-1]
+        gierr[t] = fprime(None,gi[t])*stateerr[t]*ci[t]
+        cierr[t] = gprime(None,ci[t])*stateerr[t]*gi[t]
+        np.dot(gateerr[t],W,out=sourceerr[t])
+    DWIP[:] = np.sum(gierr[1:n]*state[:n-1],axis=(0,1))
+    DWFP[:] = np.sum(gferr[1:n]*state[:n-1],axis=(0,1))
+    DWOP[:] = np.sum(goerr[:n]*state[:n],axis=(0,1))
+    # all four gates in one product (the forget gate errors are zero at t=0)
+    DW = np.dot(gateerr[:n].reshape(-1,4*ns).T,source[:n].reshape(-1,na))
+    DWGI[:],DWGF[:],DWGO[:],DWCI[:] = DW[:ns],DW[ns:2*ns],DW[2*ns:3*ns],DW[3*ns:]
+
+def reversed_index(n,lengths):
+    """Compute time indexes that reverse each sequence of a batch
+    padded at the end within its own length (leaving the padding
+    in place). The permutation is its own inverse."""
+    t = np.arange(n)[:,np.newaxis]
+    lengths = np.asarray(lengths)[np.newaxis,:]
+    return np.where(t<lengths,lengths-1-t,t)
 
 def backward_py(n,N,ni,ns,na,deltas,
                     source,
@@ -493,6 +704,16 @@ class LSTM(Network):
         weights = "WGI WGF WGO WCI WIP WFP WOP"
         for w in weights.split():
             yield(getattr(self,w),getattr(self,"D"+w),w)
+    def replicate(self):
+        net = copy.copy(self)
+        net.allocate(self.maxlen,getattr(self,"inference",False))
+        return net
+    def setPrecision(self,dtype):
+        for w in "WGI WGF WGO WCI WIP WFP WOP".split():
+            setattr(self,w,getattr(self,w).astype(dtype))
+            setattr(self,"D"+w,getattr(self,"D"+w).astype(dtype))
+        # reallocate the internal state variables with the new type
+        self.allocate(self.maxlen,getattr(self,"inference",False))
     def info(self):
         "Print info about the internal state"
         vars = "WGI WGF WGO WIP WFP WOP cix ci gix gi gox go gfx gf"
@@ -500,30 +721,55 @@ class LSTM(Network):
         vars = vars.split()
         vars = sorted(vars)
         for v in vars:
+            if getattr(self,v) is None: continue
             a = np.array(getattr(self,v))
             LOG.info("{} {} {} {}".format(v, a.shape, np.amin(a), np.amax(a)))
     def preSave(self):
-        self.max_n = max(500,len(self.ci))
+        self.max_n = max(500,self.maxlen)
         self.allocate(1)
     def postLoad(self):
         self.allocate(getattr(self,"max_n",5000))
-    def allocate(self,n):
+    # internal state variables of forward propagation
+    forward_vars = "cix ci gix gi gox go gfx gf state output source".split()
+    # internal state variables only needed for backward propagation
+    backward_vars = "gierr gferr goerr cierr stateerr outerr sourceerr".split()
+    def allocate(self,n,inference=False):
         """Allocate space for the internal state variables.
-        `n` is the maximum sequence length that can be processed."""
+        `n` is the maximum sequence length that can be processed.
+        With `inference`, only the variables for forward propagation
+        are allocated, and only on demand (see `grow`)."""
+        self.maxlen = n
+        self.inference = inference
+        for v in self.forward_vars+self.backward_vars:
+            setattr(self,v,None)
+        if inference:
+            self.grow(0)
+        else:
+            self.grow(n,backward=True)
+    def grow(self,n,backward=False):
+        """Make sure there is space in the internal state variables (for
+        forward propagation, and optionally for backward propagation too)
+        for `n` time steps. Variables are enlarged geometrically, up to
+        the maximum sequence length (beyond which this raises an error)."""
         ni,ns,na = self.dims
-        vars = "cix ci gix gi gox go gfx gf"
-        vars += " state output gierr gferr goerr cierr stateerr outerr"
-        for v in vars.split():
-            setattr(self,v,np.nan*np.ones((n,ns)))
-        self.source = np.nan*np.ones((n,na))
-        self.sourceerr = np.nan*np.ones((n,na))
+        if n>self.maxlen: raise RecognitionError("input too large for LSTM model")
+        vars = self.forward_vars
+        if backward: vars = vars+self.backward_vars
+        for v in vars:
+            a = getattr(self,v)
+            size = 0 if a is None else len(a)
+            if a is not None and size>=n: continue
+            size = min(self.maxlen,max(n,2*size))
+            shape = (size,na if v.startswith("source") else ns)
+            setattr(self,v,np.full(shape,np.nan,dtype=self.WGI.dtype))
     def reset(self,n):
-        """Reset the contents of the internal state variables to `nan`"""
-        vars = "cix ci gix gi gox go gfx gf"
-        vars += " state output gierr gferr goerr cierr stateerr outerr"
-        vars += " source sourceerr"
-        for v in vars.split():
-            getattr(self,v)[:,:] = np.nan
+        """Reset the contents of the internal state variables to `nan`
+        for the first `n` time steps (or entirely with `debug_reset`)."""
+        rows = slice(None) if debug_reset else slice(0,n)
+        for v in self.forward_vars+self.backward_vars:
+            a = getattr(self,v)
+            if a is not None:
+                a[rows] = np.nan
     def forward(self,xs):
         """Perform forward propagation of activations and update the
         internal state for a subsequent call to `backward`.
@@ -535,8 +781,8 @@ class LSTM(Network):
         assert len(xs[0])==ni
         n = len(xs)
         self.last_n = n
+        self.grow(n)
         N = len(self.gi)
-        if n>N: raise RecognitionError("input too large for LSTM model")
         self.reset(n)
         forward_py(n,N,ni,ns,na,xs,
                    self.source,
@@ -547,6 +793,65 @@ class LSTM(Network):
                    self.WIP,self.WFP,self.WOP)
         assert not np.isnan(self.output[:n]).any()
         return self.output[:n]
+    def predict(self,xs,initial=None):
+        """Perform forward propagation of activations for inference only,
+        using the fused-gate kernel. Since no `backward` can follow,
+        only the states and outputs get updated. To continue a previous
+        sequence, pass its last state and output as `initial`."""
+        ni,ns,na = self.dims
+        xs = np.asarray(xs,dtype=self.WGI.dtype)
+        assert len(xs[0])==ni
+        n = len(xs)
+        self.last_n = n
+        self.grow(n)
+        self.reset(n)
+        forward_fused_py(n,ni,ns,na,xs,
+                         self.state,self.output,
+                         self.WGI,self.WGF,self.WGO,self.WCI,
+                         self.WIP,self.WFP,self.WOP,
+                         initial=initial)
+        return self.output[:n]
+    def predictChunked(self,xs,chunk,overlap):
+        """Perform forward propagation for inference in windows of `chunk`
+        time steps, carrying the state over from one window to the next
+        (so the result is the same as with `predict`)."""
+        ni,ns,na = self.dims
+        n = len(xs)
+        outputs = np.zeros((n,ns),dtype=self.WGI.dtype)
+        initial = None
+        for start in range(0,n,chunk):
+            end = min(n,start+chunk)
+            outputs[start:end] = self.predict(xs[start:end],initial=initial)
+            initial = (self.state[end-start-1].copy(),self.output[end-start-1].copy())
+        return outputs
+    def forward_batch(self,xs,lengths,train=False):
+        """Perform forward propagation of activations for a padded
+        batch of sequences, i.e. a 3D array of shape (time,batch,inputs).
+        This does not update the internal state (and thus cannot
+        be followed by `backward`). With `train`, the activations
+        of all time steps are kept for `backward_batch` instead."""
+        ni,ns,na = self.dims
+        xs = np.asarray(xs,dtype=self.WGI.dtype)
+        assert xs.shape[2]==ni
+        n = len(xs)
+        if n>self.maxlen: raise RecognitionError("input too large for LSTM model")
+        if train:
+            shape = (n,xs.shape[1])
+            self.batch = dict(source=np.zeros(shape+(na,),dtype=xs.dtype))
+            for v in "gi gf go ci state output".split():
+                self.batch[v] = np.zeros(shape+(ns,),dtype=xs.dtype)
+            b = self.batch
+            forward_batch_train_py(n,ni,ns,na,xs,
+                                   b["source"],b["gi"],b["gf"],b["go"],b["ci"],
+                                   b["state"],b["output"],
+                                   self.WGI,self.WGF,self.WGO,self.WCI,
+                                   self.WIP,self.WFP,self.WOP)
+            return b["output"]
+        output = np.zeros((n,xs.shape[1],ns),dtype=xs.dtype)
+        forward_batch_py(n,ni,ns,na,xs,output,
+                         self.WGI,self.WGF,self.WGO,self.WCI,
+                         self.WIP,self.WFP,self.WOP)
+        return output
     def backward(self,deltas):
         """Perform backward propagation of deltas. Must be called after `forward`.
         Does not perform weight updating (for that, use the generic `update` method).
@@ -554,8 +859,8 @@ class LSTM(Network):
         ni,ns,na = self.dims
         n = len(deltas)
         self.last_n = n
+        self.grow(n,backward=True)
         N = len(self.gi)
-        if n>N: raise RecognitionError("input too large for LSTM model")
         backward_py(n,N,ni,ns,na,deltas,
                     self.source,
                     self.gix,self.gfx,self.gox,self.cix,
@@ -569,6 +874,26 @@ class LSTM(Network):
                     self.DWGI,self.DWGF,self.DWGO,self.DWCI,
                     self.DWIP,self.DWFP,self.DWOP)
         return [s[1:1+ni] for s in self.sourceerr[:n]]
+    def backward_batch(self,deltas):
+        """Perform backward propagation of deltas for a batch of sequences
+        (see `Network.backward_batch`). Must be called after `forward_batch`
+        with `train`. Returns the deltas for the input vectors."""
+        ni,ns,na = self.dims
+        b = self.batch
+        n,B = deltas.shape[:2]
+        sourceerr = np.zeros((n,B,na),dtype=deltas.dtype)
+        gateerr = np.zeros((n,B,4*ns),dtype=deltas.dtype)
+        stateerr = np.zeros((n,B,ns),dtype=deltas.dtype)
+        outerr = np.zeros((n,B,ns),dtype=deltas.dtype)
+        backward_batch_py(n,ni,ns,na,deltas,
+                          b["source"],b["gi"],b["gf"],b["go"],b["ci"],b["state"],
+                          self.WGI,self.WGF,self.WGO,self.WCI,
+                          self.WIP,self.WFP,self.WOP,
+                          sourceerr,gateerr,stateerr,outerr,
+                          self.DWGI,self.DWGF,self.DWGO,self.DWCI,
+                          self.DWIP,self.DWFP,self.DWOP)
+        self.batch = None
+        return sourceerr[:,:,1:1+ni]
 
 ################################################################
 # combination classifiers
@@ -584,6 +909,10 @@ class Stacked(Network):
         yield self
         for sub in self.nets:
             for x in sub.walk(): yield x
+    def replicate(self):
+        net = copy.copy(self)
+        net.nets = [sub.replicate() for sub in self.nets]
+        return net
     def ninputs(self):
         return self.nets[0].ninputs()
     def noutputs(self):
@@ -592,6 +921,22 @@ class Stacked(Network):
         for i,net in enumerate(self.nets):
             xs = net.forward(xs)
         return xs
+    def predict(self,xs):
+        for net in self.nets:
+            xs = net.predict(xs)
+        return xs
+    def predictChunked(self,xs,chunk,overlap):
+        for net in self.nets:
+            xs = net.predictChunked(xs,chunk,overlap)
+        return xs
+    def forward_batch(self,xs,lengths,train=False):
+        for net in self.nets:
+            xs = net.forward_batch(xs,lengths,train=train)
+        return xs
+    def backward_batch(self,deltas):
+        for net in reversed(self.nets):
+            deltas = net.backward_batch(deltas)
+        return deltas
     def backward(self,deltas):
         self.ldeltas = [deltas]
         for i,net in reversed(list(enumerate(self.nets))):
@@ -620,12 +965,41 @@ class Reversed(Network):
     def walk(self):
         yield self
         for x in self.net.walk(): yield x
+    def replicate(self):
+        net = copy.copy(self)
+        net.net = self.net.replicate()
+        return net
     def ninputs(self):
         return self.net.ninputs()
     def noutputs(self):
         return self.net.noutputs()
     def forward(self,xs):
         return self.net.forward(xs[::-1])[::-1]
+    def predict(self,xs):
+        return self.net.predict(xs[::-1])[::-1]
+    def predictChunked(self,xs,chunk,overlap):
+        """Predict on the time-reversed input in windows of `chunk` time steps.
+        The state cannot be carried over backwards, so each window starts
+        `overlap` steps later (if possible) to let the state settle, and
+        only the outputs within the window are kept."""
+        n = len(xs)
+        outputs = None
+        for start in range(0,n,chunk):
+            end = min(n,start+chunk)
+            output = self.net.predict(xs[start:min(n,end+overlap)][::-1])[::-1]
+            if outputs is None:
+                outputs = np.zeros((n,)+output.shape[1:],dtype=output.dtype)
+            outputs[start:end] = output[:end-start]
+        return outputs
+    def forward_batch(self,xs,lengths,train=False):
+        index = reversed_index(len(xs),lengths)
+        batch = np.arange(len(lengths))
+        if train: self.batch = (index,batch)
+        return self.net.forward_batch(xs[index,batch],lengths,train=train)[index,batch]
+    def backward_batch(self,deltas):
+        (index,batch),self.batch = self.batch,None
+        result = self.net.backward_batch(deltas[index,batch])
+        return result[index,batch] if result is not None else None
     def backward(self,deltas):
         result = self.net.backward(deltas[::-1])
         return result[::-1] if result is not None else None
@@ -645,11 +1019,31 @@ class Parallel(Network):
         yield self
         for sub in self.nets:
             for x in sub.walk(): yield x
+    def replicate(self):
+        net = copy.copy(self)
+        net.nets = tuple(sub.replicate() for sub in self.nets)
+        return net
     def forward(self,xs):
         outputs = [net.forward(xs) for net in self.nets]
         outputs = list(zip(*outputs))
         outputs = [np.concatenate(l) for l in outputs]
         return outputs
+    def predict(self,xs):
+        outputs = [net.predict(xs) for net in self.nets]
+        return np.concatenate(outputs,axis=1)
+    def predictChunked(self,xs,chunk,overlap):
+        outputs = [net.predictChunked(xs,chunk,overlap) for net in self.nets]
+        return np.concatenate(outputs,axis=1)
+    def forward_batch(self,xs,lengths,train=False):
+        outputs = [net.forward_batch(xs,lengths,train=train) for net in self.nets]
+        return np.concatenate(outputs,axis=2)
+    def backward_batch(self,deltas):
+        start = 0
+        for net in self.nets:
+            k = net.noutputs()
+            net.backward_batch(deltas[:,:,start:start+k])
+            start += k
+        return None
     def backward(self,deltas):
         deltas = np.array(deltas)
         start = 0
@@ -734,6 +1128,27 @@ def translate_back0(outputs,threshold=0.25):
                 result.append(cs[i])
     return result
 
+def ctc_decode(outputs,threshold=0.7):
+    """Translate back in one pass. Thresholds on class 0, then assigns the maximum
+    class to each region. On ties, the position is the last row (time step) attaining
+    the region's maximum, and the class is the highest class index attaining it there.
+    Returns three arrays: the recognized classes, their positions (time steps), and
+    their probabilities."""
+    mask = outputs[:,0]<threshold
+    steps = np.diff(mask.astype(np.int8),prepend=0,append=0)
+    starts = np.flatnonzero(steps==1)
+    if len(starts)==0:
+        return np.zeros(0,int),np.zeros(0,int),np.zeros(0,outputs.dtype)
+    rowmax = np.amax(outputs,axis=1)
+    # maximum of each region (rows outside of regions cannot contribute)
+    maxima = np.maximum.reduceat(np.where(mask,rowmax,-np.inf),starts)
+    # region index of each row, and the last row attaining the region's maximum
+    regions = np.cumsum(steps[:-1]==1)-1
+    rows = np.flatnonzero(mask & (rowmax==maxima[regions]))
+    positions = rows[np.r_[np.flatnonzero(np.diff(regions[rows])),len(rows)-1]]
+    classes = outputs.shape[1]-1-np.argmax(outputs[positions,::-1],axis=1)
+    return classes,positions,maxima.astype(outputs.dtype)
+
 def translate_back(outputs,threshold=0.7,pos=0):
     """Translate back. Thresholds on class 0, then assigns the maximum class to
     each region. ``pos`` determines the depth of character information returned:
@@ -741,50 +1156,62 @@ def translate_back(outputs,threshold=0.7,pos=0):
         * `pos=1`: Return list of position-character tuples
         * `pos=2`: Return list of character-probability tuples
      """
-    labels,n = measurements.label(outputs[:,0]<threshold)
-    mask = np.tile(labels.reshape(-1,1),(1,outputs.shape[1]))
-    maxima = measurements.maximum_position(outputs,mask,np.arange(1,np.amax(mask)+1))
-    if pos==1: return maxima # include character position
-    if pos==2: return [(c, outputs[r,c]) for (r,c) in maxima] # include character probabilities
-    return [c for (r,c) in maxima] # only recognized characters
+    classes,positions,probs = ctc_decode(outputs,threshold=threshold)
+    if pos==1: return list(zip(positions.tolist(),classes.tolist())) # include character position
+    if pos==2: return list(zip(classes.tolist(),probs.tolist())) # include character probabilities
+    return classes.tolist() # only recognized characters
 
 def log_mul(x,y):
     "Perform multiplication in the log domain (i.e., addition)."
     return x+y
 
-def log_add(x,y):
-    "Perform addition in the log domain."
-    #return np.where(np.abs(x-y)>10,np.maximum(x,y),np.log(np.exp(x-y)+1)+y)
-    return np.where(np.abs(x-y)>10,np.maximum(x,y),np.log(np.exp(np.clip(x-y,-20,20))+1)+y)
+def log_add(x,y,out=None):
+    """Perform addition in the log domain (like `np.logaddexp`, but
+    ignoring the smaller summand beyond a difference of 10)."""
+    d = np.abs(x-y)
+    np.copyto(d,np.inf,where=d>10)
+    np.negative(d,out=d)
+    np.log1p(np.exp(d,out=d),out=d)
+    result = np.maximum(x,y,out=out)
+    result += d
+    return result
 
 def forward_algorithm(match,skip=-5.0):
     """Apply the forward algorithm to an array of log state
-    correspondence probabilities."""
-    v = skip*np.arange(len(match[0]))
-    result = []
+    correspondence probabilities. `match` may also hold several
+    independent problems along the second axis, i.e. have the
+    shape (time,problems,states)."""
+    match = np.asarray(match)
+    result = np.empty(match.shape,'f')
+    v = np.empty(match.shape[1:])
+    v[...] = skip*np.arange(match.shape[-1])
+    w = np.empty_like(v)
     # This is a fairly straightforward dynamic programming problem and
     # implemented in close analogy to the edit distance:
     # we either stay in the same state at no extra cost or make a diagonal
     # step (transition into new state) at no extra cost; the only costs come
     # from how well the symbols match the network output.
     for i in range(0,len(match)):
-        w = np.roll(v,1).copy()
+        w[...,1:] = v[...,:-1]
         # extra cost for skipping initial symbols
-        w[0] = skip*i
+        w[...,0] = skip*i
         # total cost is match cost of staying in same state
         # plus match cost of making a transition into the next state
-        v = log_add(log_mul(v,match[i]),log_mul(w,match[i]))
-        result.append(v)
-    return np.array(result,'f')
+        v += match[i]
+        w += match[i]
+        log_add(v,w,out=v)
+        result[i] = v
+    return result
 
 def forwardbackward(lmatch):
     """Apply the forward-backward algorithm to an array of log state
     correspondence probabilities."""
-    lr = forward_algorithm(lmatch)
-    # backward is just forward applied to the reversed sequence
-    rl = forward_algorithm(lmatch[::-1,::-1])[::-1,::-1]
-    both = lr+rl
-    return both
+    # backward is just forward applied to the reversed sequence,
+    # so run both at once
+    both = forward_algorithm(np.stack([lmatch,lmatch[::-1,::-1]],axis=1))
+    lr = both[:,0]
+    rl = both[::-1,1,::-1]
+    return lr+rl
 
 def ctc_align_targets(outputs,targets,threshold=100.0,verbose=0,debug=0,lo=1e-5):
     """Perform alignment between the `outputs` of a neural network
@@ -855,6 +1282,12 @@ class SeqRecognizer:
         self.clear_log()
     def walk(self):
         for x in self.lstm.walk(): yield x
+    def replicate(self):
+        """Return a copy of the recognizer sharing the weights (and codec)
+        with this one, but with its own internal state (see `Network.replicate`)."""
+        net = copy.copy(self)
+        net.lstm = self.lstm.replicate()
+        return net
     def clear_log(self):
         self.command_log = []
         self.error_log = []
@@ -873,12 +1306,29 @@ class SeqRecognizer:
         self.lstm.info()
     def setLearningRate(self,r,momentum=0.9):
         self.lstm.setLearningRate(r,momentum)
-    def predictSequence(self,xs):
-        "Predict an integer sequence of codes."
+    def predictSequence(self,xs,chunk=2000,overlap=200):
+        """Predict an integer sequence of codes. Sequences too long for the
+        allocated state are predicted in windows of `chunk` time steps
+        (with `overlap` steps of context for the reverse direction)."""
         assert xs.shape[1]==self.Ni,\
             "wrong image height (image: %d, expected: %d)"%(xs.shape[1],self.Ni)
-        self.outputs = np.array(self.lstm.forward(xs))
+        try:
+            self.outputs = np.array(self.lstm.predict(xs))
+        except RecognitionError:
+            self.outputs = np.array(self.lstm.predictChunked(xs,chunk,overlap))
         return translate_back(self.outputs)
+    def predictBatch(self,lines):
+        """Predict the output activations for a list of sequences at once,
+        by padding them into a single batch. Returns a list of 2D arrays
+        (one per sequence, in the same order)."""
+        lengths = [len(xs) for xs in lines]
+        batch = np.zeros((max(lengths),len(lines),self.Ni))
+        for b,xs in enumerate(lines):
+            assert xs.shape[1]==self.Ni,\
+                "wrong image height (image: %d, expected: %d)"%(xs.shape[1],self.Ni)
+            batch[:len(xs),b] = xs
+        outputs = self.lstm.forward_batch(batch,lengths)
+        return [outputs[:l,b] for b,l in enumerate(lengths)]
     def trainSequence(self,xs,cs,update=1,key=None):
         "Train with an integer sequence of codes."
         assert xs.shape[1]==self.Ni,"wrong image height"
@@ -902,6 +1352,45 @@ class SeqRecognizer:
         # training keys
         self.key_log.append(key)
         return result
+    def trainBatch(self,lines,css,update=1,keys=None):
+        """Train with a list of sequences and their integer sequences of codes
+        at once, by padding them into a single batch. The weight deltas of all
+        sequences are summed up and applied in a single update. Returns the
+        list of recognized code sequences (and keeps the list of alignments
+        and errors in `aligned_batch` and `error_batch`)."""
+        if keys is None: keys = [None]*len(lines)
+        lengths = [len(xs) for xs in lines]
+        batch = np.zeros((max(lengths),len(lines),self.Ni))
+        for b,xs in enumerate(lines):
+            assert xs.shape[1]==self.Ni,"wrong image height"
+            batch[:len(xs),b] = xs
+        # forward step
+        outputs = self.lstm.forward_batch(batch,lengths,train=True)
+        # CTC alignment (deltas stay zero in the padding)
+        deltas = np.zeros(outputs.shape)
+        results,self.aligned_batch,self.error_batch = [],[],[]
+        for b,(l,cs,key) in enumerate(zip(lengths,css,keys)):
+            self.outputs = outputs[:l,b]
+            self.targets = np.array(make_target(cs,self.No))
+            self.aligned = np.array(ctc_align_targets(self.outputs,self.targets,debug=self.debug_align))
+            deltas[:l,b] = self.aligned-self.outputs
+            # translate back into a sequence
+            result = translate_back(self.outputs)
+            results.append(result)
+            # compute least square error
+            self.error = np.sum(deltas[:l,b]**2)
+            self.error_log.append(self.error**.5/len(cs))
+            # compute class error
+            self.cerror = levenshtein(cs,result)
+            self.cerror_log.append((self.cerror,len(cs)))
+            # training keys
+            self.key_log.append(key)
+            self.aligned_batch.append(self.aligned)
+            self.error_batch.append(self.error)
+        # propagate the deltas back
+        self.lstm.backward_batch(deltas)
+        if update: self.lstm.update()
+        return results
     # we keep track of errors within the object; this even gets
     # saved to give us some idea of the training history
     def errors(self,range=10000,smooth=0):
@@ -969,6 +1458,78 @@ def ocropus_codec():
     extra = [c for c in ocrolib.chars.default if c not in base_set]
     return Codec().init(base+extra)
 
+################################################################
+# conversion of recognizers to and from plain arrays (e.g. for
+# uncompressed .npz files that can be memory-mapped on loading)
+################################################################
+
+def network_to_arrays(network,dtype=None):
+    """Convert a `SeqRecognizer` based on a `BIDILSTM` into a dict of
+    arrays: the weights (by name, see `Network.weights`), the dimensions,
+    the codec's characters (by code) and the line normalizer's parameters.
+    Training logs are not included. Weights are converted to `dtype`
+    if given."""
+    weights = dict((n,w) for w,dw,n in network.lstm.weights())
+    expected = ["Stacked1/Softmax"]
+    for prefix in ["Stacked0/Parallel0/","Stacked0/Parallel1/Reversed/"]:
+        expected += [prefix+w for w in "WGI WGF WGO WCI WIP WFP WOP".split()]
+    if sorted(weights.keys())!=sorted(expected):
+        raise ValueError("can only convert BIDILSTM recognizers, not %s"%sorted(weights.keys()))
+    arrays = dict((n,np.asarray(w,dtype=dtype)) for n,w in weights.items())
+    lstm = network.lstm.nets[0].nets[0]
+    arrays["dims"] = np.array([network.Ni,lstm.dims[1],network.No])
+    arrays["maxlen"] = np.array([getattr(lstm,"max_n",getattr(lstm,"maxlen",5000))])
+    arrays["last_trial"] = np.array([getattr(network,"last_trial",0)])
+    arrays["codec"] = np.array([network.codec.code2char[c]
+                                for c in range(network.codec.size())])
+    lnorm = getattr(network,"lnorm",None)
+    if lnorm is not None:
+        arrays["lnorm"] = np.array([lnorm.target_height,lnorm.range,lnorm.smoothness,lnorm.extra])
+    return arrays
+
+def network_from_arrays(arrays):
+    """Create a `SeqRecognizer` from the arrays of `network_to_arrays`.
+    The arrays are used as weights directly (without copying), so
+    memory-mapped arrays stay shared with other processes."""
+    ni,ns,no = [int(x) for x in arrays["dims"]]
+    def make_lstm(prefix):
+        # bypass the constructor to avoid random initialization
+        net = LSTM.__new__(LSTM)
+        net.dims = ni,ns,1+ni+ns
+        for w in "WGI WGF WGO WCI WIP WFP WOP".split():
+            setattr(net,w,arrays[prefix+w])
+            # (deltas in the same precision as the weights)
+            setattr(net,"D"+w,np.zeros(arrays[prefix+w].shape,dtype=arrays[prefix+w].dtype))
+        # same state as after `preSave` (so `postLoad` applies)
+        net.allocate(1)
+        net.max_n = int(arrays["maxlen"][0])
+        return net
+    softmax = Softmax.__new__(Softmax)
+    softmax.Nh = 2*ns
+    softmax.No = no
+    softmax.W2 = arrays["Stacked1/Softmax"]
+    softmax.DW2 = np.zeros(softmax.W2.shape,dtype=softmax.W2.dtype)
+    bidi = Parallel(make_lstm("Stacked0/Parallel0/"),
+                    Reversed(make_lstm("Stacked0/Parallel1/Reversed/")))
+    codec = Codec()
+    codec.code2char = dict(enumerate(str(c) for c in arrays["codec"]))
+    codec.char2code = dict((c,code) for code,c in codec.code2char.items())
+    network = SeqRecognizer.__new__(SeqRecognizer)
+    network.Ni = ni
+    network.No = no
+    network.lstm = Stacked([bidi,softmax])
+    network.setLearningRate(1e-4)
+    network.debug_align = 0
+    network.normalize = normalize_nfkc
+    network.codec = codec
+    network.clear_log()
+    network.last_trial = int(arrays["last_trial"][0])
+    if "lnorm" in arrays:
+        from .lineest import CenterNormalizer
+        height,params = arrays["lnorm"][0],arrays["lnorm"][1:]
+        network.lnorm = CenterNormalizer(int(height),tuple(float(p) for p in params))
+    return network
+
 def getstates_for_display(net):
     """Get internal states of an LSTM network for making nice state
     plots. This only works on a few types of LSTM."""
@@ -1,18 +1,577 @@
 #!/usr/bin/env python
 
-import re, traceback, sys
+import traceback, sys, os, shutil, tempfile, zipfile, queue, copy, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from rapidfuzz.distance import Levenshtein
 
 import random as pyrandom
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 np.seterr(divide='raise',over='raise',invalid='raise',under='ignore')
 
 from ocrd_cis.ocropy import ocrolib
 from ocrd_cis.ocropy.ocrolib import lstm, lineest
-
-
-
-def rtrain(inputs, load, output, ntrain):
+from ocrd_cis.ocropy.recognize import load_network, schedule_batches
+
+
+def write_arrays(fname, streamed, arrays):
+    """Write `arrays` (a dict of arrays) into `fname` (an uncompressed
+    .npz file), plus the array `streamed` given as a tuple of name, dtype,
+    shape and an open file with its data (copied over in chunks)."""
+    name,dtype,shape,stream = streamed
+    with zipfile.ZipFile(fname,"w",zipfile.ZIP_STORED,allowZip64=True) as archive:
+        with archive.open(name+".npy","w",force_zip64=True) as member:
+            np.lib.format.write_array_header_2_0(member, {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                "fortran_order": False,
+                "shape": shape})
+            shutil.copyfileobj(stream,member)
+        for name,array in arrays.items():
+            with archive.open(name+".npy","w",force_zip64=True) as member:
+                np.lib.format.write_array(member,array,allow_pickle=False)
+
+def save_line_pairs(fname, pairs, height=48):
+    """Store text line images with their transcripts into `fname`
+    (an uncompressed .npz file), so they can be used as `LinePairs`.
+    Returns the number of lines stored.
+
+    `pairs` yields tuples of key, name, image (a uint8 array of
+    `height` rows) and transcript. The images are transposed and
+    concatenated into `images` (streamed to disk to keep memory
+    bounded), with their start offsets in `offsets`. The file is
+    written under a temporary name and only replaces `fname` when
+    complete.
+    """
+    offsets = [0]
+    keys, names, transcripts = [], [], []
+    with tempfile.TemporaryFile() as stream:
+        for key, name, image, transcript in pairs:
+            assert image.shape[0]==height, image.shape
+            stream.write(np.ascontiguousarray(image.T,dtype='B').tobytes())
+            offsets.append(offsets[-1]+image.shape[1])
+            keys.append(key)
+            names.append(name)
+            transcripts.append(transcript)
+        stream.seek(0)
+        write_arrays(fname+".tmp", ("images",'B',(offsets[-1],height),stream),
+                     dict(offsets=np.array(offsets,'int64'),
+                          keys=np.array(keys,'U'),
+                          names=np.array(names,'U'),
+                          transcripts=np.array(transcripts,'U')))
+    os.replace(fname+".tmp",fname)
+    return len(keys)
+
+class LinePairs:
+    """Text line images with their transcripts, as stored by
+    `save_line_pairs` (instead of one image file and one .gt.txt
+    file per line). The file is memory-mapped. Each line has a
+    `key` (a content hash) to find it again in later runs."""
+    def __init__(self, fname):
+        arrays = ocrolib.load_arrays(fname)
+        self.images = arrays["images"]
+        self.offsets = arrays["offsets"]
+        self.keys = arrays["keys"]
+        self.names = arrays["names"]
+        self.transcripts = arrays["transcripts"]
+    def __len__(self):
+        return len(self.keys)
+    def __getitem__(self, i):
+        """Return the name, image (uint8) and transcript of the `i`-th line."""
+        image = self.images[self.offsets[i]:self.offsets[i+1]].T
+        return str(self.names[i]), image, str(self.transcripts[i])
+    def index(self):
+        """Map the keys of all lines to their position."""
+        return {key: i for i, key in enumerate(self.keys.tolist())}
+
+def input_ids(inputs):
+    """Identify the lines of `inputs` (for `shard_current`): by file
+    name for image files, or by key for `LinePairs`."""
+    if isinstance(inputs, LinePairs):
+        return inputs.keys.tolist()
+    return [input for input in inputs if input is not None]
+
+def prepare_lines(inputs, lnorm, codec, fname):
+    """Normalize all text line images in `inputs` (image files with
+    transcripts in .gt.txt files next to them, or `LinePairs`) once,
+    and store them into `fname` (an uncompressed .npz file), so
+    training can sample from them with `LineShard`.
+
+    The normalized lines are transposed and concatenated into `lines`
+    (float32, streamed to disk to keep memory bounded), with their
+    start offsets in `offsets`. The encoded transcripts are concatenated
+    into `codes`, with their start offsets in `code_offsets`. The plain
+    `transcripts` and `files` (or line names) are kept for reporting,
+    and the ids of all `inputs` (including empty ones), the parameters
+    of `lnorm` and the characters of `codec` for `shard_current`.
+    """
+    height = lnorm.target_height
+    ids = input_ids(inputs)
+    if isinstance(inputs, LinePairs):
+        pairs = (inputs[i] for i in range(len(inputs)))
+    else:
+        pairs = ((input, ocrolib.read_image_gray(input),
+                  ocrolib.read_text(ocrolib.allsplitext(input)[0]+".gt.txt"))
+                 for input in ids)
+    offsets, code_offsets = [0], [0]
+    codes, transcripts, files = [], [], []
+    with tempfile.TemporaryFile() as stream:
+        for input, line, transcript in pairs:
+            if line.dtype==np.uint8:
+                # same as read_image_gray
+                line = line/255.0
+            lnorm.measure(np.amax(line)-line)
+            line = lnorm.normalize(line,cval=np.amax(line))
+            if line.size<10 or np.amax(line)==np.amin(line):
+                print("EMPTY-INPUT", input)
+                continue
+            stream.write(np.ascontiguousarray(line.T,dtype='f').tobytes())
+            offsets.append(offsets[-1]+line.shape[1])
+            cs = codec.encode(transcript)
+            codes.extend(cs)
+            code_offsets.append(code_offsets[-1]+len(cs))
+            transcripts.append(transcript)
+            files.append(input)
+        stream.seek(0)
+        write_arrays(fname, ("lines",'<f4',(offsets[-1],height),stream),
+                     dict(offsets=np.array(offsets,'int64'),
+                          codes=np.array(codes,'i'),
+                          code_offsets=np.array(code_offsets,'int64'),
+                          transcripts=np.array(transcripts,'U'),
+                          files=np.array(files,'U'),
+                          inputs=np.array(ids,'U'),
+                          lnorm=lnorm_params(lnorm),
+                          codec=codec_chars(codec)))
+    print("# prepared", len(files), "lines with", offsets[-1], "columns in", fname)
+
+def lnorm_params(lnorm):
+    """The parameters of the line normalizer `lnorm` (as stored in shards)."""
+    return np.array([lnorm.target_height,lnorm.range,lnorm.smoothness,lnorm.extra],'float64')
+
+def codec_chars(codec):
+    """The characters of `codec` by code (as stored in shards)."""
+    return np.array([codec.code2char[c] for c in range(codec.size())],'U')
+
+def shard_current(fname, inputs, lnorm, codec):
+    """Whether the shard `fname` exists, was prepared by `prepare_lines`
+    from the same `inputs` with the same line normalizer `lnorm` and
+    `codec`, and is newer than all of them (and their transcripts).
+    (For `LinePairs`, the keys identify the content, so no file times
+    are needed.)"""
+    if not os.path.exists(fname):
+        return False
+    ids = input_ids(inputs)
+    if not isinstance(inputs, LinePairs):
+        mtime = os.path.getmtime(fname)
+        for input in ids:
+            base,_ = ocrolib.allsplitext(input)
+            if os.path.getmtime(input)>mtime or os.path.getmtime(base+".gt.txt")>mtime:
+                return False
+    arrays = ocrolib.load_arrays(fname)
+    if "lnorm" not in arrays or "codec" not in arrays:
+        return False
+    return (np.array_equal(arrays["lnorm"],lnorm_params(lnorm)) and
+            arrays["codec"].tolist()==codec_chars(codec).tolist() and
+            arrays["inputs"].tolist()==ids)
+
+class LineShard:
+    """Text lines for training, as normalized once by `prepare_lines`.
+    The shard file is memory-mapped, and the lines prepared for the
+    network (inverted, transposed and padded) are kept in a LRU cache
+    of at most `maxbytes`."""
+    def __init__(self, fname, pad=16, maxbytes=1<<30):
+        arrays = ocrolib.load_arrays(fname)
+        self.lines = arrays["lines"]
+        self.offsets = arrays["offsets"]
+        self.codes = arrays["codes"]
+        self.code_offsets = arrays["code_offsets"]
+        self.transcripts = arrays["transcripts"]
+        self.files = arrays["files"]
+        self.pad = pad
+        self.maxbytes = maxbytes
+        self.cache = OrderedDict()
+        self.nbytes = 0
+    def __len__(self):
+        return len(self.files)
+    def __getitem__(self, i):
+        """Return the file name, transcript, prepared line and encoded
+        transcript of the `i`-th line."""
+        line = self.cache.get(i)
+        if line is None:
+            line = self.lines[self.offsets[i]:self.offsets[i+1]].T
+            # same as in ocropus-rtrain (but with the normalized line from the shard)
+            line = line * 1.0/np.amax(line)
+            line = np.amax(line)-line
+            line = line.T
+            if self.pad>0:
+                w = line.shape[1]
+                line = np.vstack([np.zeros((self.pad,w)),line,np.zeros((self.pad,w))])
+            self.cache[i] = line
+            self.nbytes += line.nbytes
+            while self.nbytes>self.maxbytes and len(self.cache)>1:
+                _,old = self.cache.popitem(last=False)
+                self.nbytes -= old.nbytes
+        else:
+            self.cache.move_to_end(i)
+        cs = self.codes[self.code_offsets[i]:self.code_offsets[i+1]]
+        return str(self.files[i]), str(self.transcripts[i]), line, cs
+
+class Sampler:
+    """Draw batches of lines for training, epoch by epoch, seeded with
+    `seed` for reproducible runs. This base class shuffles the lines of
+    `indexes` uniformly, so each is drawn once per epoch; subclasses
+    implement other strategies (see `SAMPLERS`). `lengths` are the
+    widths of all lines of the shard.
+
+    After training on a batch, pass the character error rates of its
+    lines to `update`; `report` prints the throughput in lines/s.
+    """
+    name = 'uniform'
+    def __init__(self, indexes, lengths, batch_size, seed=0):
+        self.indexes = np.array(indexes,dtype=int)
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.random = np.random.RandomState(seed)
+        self.epoch = 0
+        self.count = 0
+        self.start = time.time()
+    def order(self):
+        """Return the lines to draw in the next epoch."""
+        return self.random.permutation(self.indexes)
+    def batches(self, order):
+        """Split the lines of an epoch into batches."""
+        return [order[i:i+self.batch_size] for i in range(0,len(order),self.batch_size)]
+    def __iter__(self):
+        while True:
+            for batch in self.batches(self.order()):
+                yield batch
+            self.epoch += 1
+    def update(self, indexes, errors):
+        """Take the character error rates `errors` of the lines `indexes`
+        just trained on."""
+        self.count += len(indexes)
+    def report(self):
+        """Print the epoch and the number of lines trained per second
+        since the last report."""
+        now = time.time()
+        print("# %s sampler: epoch %d, %.1f lines/s" % (
+            self.name, self.epoch, self.count/max(1e-6,now-self.start)))
+        self.count = 0
+        self.start = now
+
+class LengthSampler(Sampler):
+    """Draw batches of lines of similar length (so minibatches need
+    little padding): each epoch, shuffle the lines, sort each window
+    of `window` batches by length, and shuffle the resulting batches."""
+    name = 'length'
+    window = 50
+    def batches(self, order):
+        size = self.batch_size*self.window
+        batches = []
+        for i in range(0,len(order),size):
+            chunk = order[i:i+size]
+            chunk = chunk[np.argsort(self.lengths[chunk],kind='stable')]
+            batches.extend(super().batches(chunk))
+        self.random.shuffle(batches)
+        return batches
+
+class LossSampler(Sampler):
+    """Oversample lines with a high character error rate: each epoch
+    draws as many lines as there are, with replacement, proportional
+    to their (smoothed) error rate, but at least a tenth of the mean.
+    Lines not trained on yet count as 100% errors."""
+    name = 'loss'
+    def __init__(self, indexes, lengths, batch_size, seed=0):
+        super().__init__(indexes, lengths, batch_size, seed=seed)
+        self.errors = np.ones(len(self.lengths))
+    def order(self):
+        errors = self.errors[self.indexes]
+        weights = np.maximum(errors,0.1*np.mean(errors))
+        if not np.sum(weights):
+            return super().order()
+        return self.random.choice(self.indexes,len(self.indexes),p=weights/np.sum(weights))
+    def update(self, indexes, errors):
+        super().update(indexes, errors)
+        self.errors[indexes] = 0.5*self.errors[indexes]+0.5*np.asarray(errors)
+
+SAMPLERS = {cls.name: cls for cls in [Sampler, LengthSampler, LossSampler]}
+
+def snapshot_network(network, strip=True):
+    """Return a copy of `network` for saving, with its own copy of the
+    weights. If `strip`, clear the training logs, and leave out the
+    internal state (as `preSave` would, but only in the copy, so the
+    state of `network` does not need to be reallocated afterwards)."""
+    memo = {}
+    if strip:
+        network.clear_log()
+        # do not copy the (large) internal state of the LSTM layers
+        for x in network.walk():
+            if isinstance(x, lstm.LSTM):
+                for v in x.forward_vars+x.backward_vars:
+                    memo[id(getattr(x,v))] = None
+    snapshot = copy.deepcopy(network, memo)
+    if strip:
+        for x in snapshot.walk(): x.preSave()
+    return snapshot
+
+class CheckpointWriter:
+    """Save checkpoints in a background thread, so training can go on
+    while they get pickled and compressed. The network is copied with
+    `snapshot_network` first. Saved checkpoints are passed on to the
+    `validator` (if any) by `poll`."""
+    def __init__(self, validator=None, strip=True):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.validator = validator
+        self.strip = strip
+        self.pending = []
+    def save(self, fname, network, trial):
+        """Save `network` (after `trial` trials) into `fname`."""
+        snapshot = snapshot_network(network, strip=self.strip)
+        future = self.executor.submit(ocrolib.save_object, fname, snapshot)
+        self.pending.append((fname, trial, future))
+    def poll(self, wait=False):
+        """Handle all saved checkpoints (or, if `wait`, all pending ones),
+        re-raising any error while saving."""
+        while self.pending and (wait or self.pending[0][2].done()):
+            fname, trial, future = self.pending.pop(0)
+            future.result()
+            if self.validator:
+                self.validator.submit(fname, trial)
+    def close(self):
+        """Wait for all pending checkpoints, then end the background thread."""
+        self.poll(wait=True)
+        self.executor.shutdown()
+
+def train_lines(network, codec, batch, trial, quiet=False):
+    """Train `network` on a `batch` of lines (as returned by `LineShard`)
+    with a single weight update, and report the results, numbering
+    the lines from `trial` on. Returns the character error rate of
+    each line (before the update)."""
+    if len(batch)==1:
+        fname, transcript, line, cs = batch[0]
+        pcss = [network.trainSequence(line,cs,update=1,key=fname)]
+        aligned, errors = [network.aligned], [network.error]
+    else:
+        # one padded batch, with a single weight update
+        pcss = network.trainBatch([line for _,_,line,_ in batch],
+                                  [cs for _,_,_,cs in batch],
+                                  update=1,
+                                  keys=[fname for fname,_,_,_ in batch])
+        aligned, errors = network.aligned_batch, network.error_batch
+    cers = []
+    for i, (fname, transcript, line, cs) in enumerate(batch):
+        pred = "".join(codec.decode(pcss[i]))
+        cers.append(Levenshtein.distance(pred,transcript)/max(1,len(transcript)))
+        acs = lstm.translate_back(aligned[i])
+        gta = "".join(codec.decode(acs))
+        if not quiet:
+            print("%d %.2f %s" % (trial+i, errors[i], line.shape), fname)
+            print("   TRU:", repr(transcript))
+            print("   ALN:", repr(gta[:len(transcript)+5]))
+            print("   OUT:", repr(pred[:len(transcript)+5]))
+    return cers
+
+def get_weights(network, out):
+    """Copy all weights of `network` into the flat array `out`."""
+    start = 0
+    for w,_,_ in network.lstm.weights():
+        out[start:start+w.size] = w.ravel()
+        start += w.size
+
+def set_weights(network, weights):
+    """Copy all weights of `network` from the flat array `weights`."""
+    start = 0
+    for w,_,_ in network.lstm.weights():
+        w[...] = weights[start:start+w.size].reshape(w.shape)
+        start += w.size
+
+def validate_worker(cache, indexes, pad, tasks, results, batch_size=16):
+    """Compute the character error rate (CER) of checkpoints on the
+    held-out lines `indexes` of the shard `cache` (see `Validator`).
+
+    Takes tuples of checkpoint file name and trial from `tasks` (until
+    None), recognizes the lines in batches of similar width with the
+    inference path, and puts tuples of file name, trial and CER into
+    `results`.
+    """
+    lines = LineShard(cache, pad=pad)
+    samples = [lines[i] for i in indexes]
+    batches = schedule_batches([len(line) for _,_,line,_ in samples], batch_size)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        fname, trial = task
+        network = load_network(fname)
+        edits = lengs = 0
+        for batch in batches:
+            xs = [samples[i][2] for i in batch]
+            try:
+                outputs = network.predictBatch(xs)
+            except lstm.RecognitionError:
+                outputs = []
+                for line in xs:
+                    network.predictSequence(line)
+                    outputs.append(network.outputs)
+            for i, output in zip(batch, outputs):
+                transcript = samples[i][1]
+                pred = network.l2s(lstm.ctc_decode(output)[0])
+                edits += Levenshtein.distance(pred, transcript)
+                lengs += len(transcript)
+        results.put((fname, trial, edits/max(1,lengs)))
+
+class Validator:
+    """Validation of checkpoints on held-out lines, for early stopping.
+
+    The checkpoints get recognized in a background process (see
+    `validate_worker`), so training does not have to wait for it.
+    The best checkpoint so far is copied to `best`. Training should
+    stop after `patience` validations without improvement (unless 0).
+    (The process is started with the first checkpoint, so in data-parallel
+    training it belongs to the worker which saves the checkpoints.)
+    """
+    def __init__(self, cache, indexes, pad, best, patience):
+        self.args = (cache, indexes, pad)
+        self.process = None
+        self.best = best
+        self.patience = patience
+        self.best_cer = np.inf
+        self.bad = 0
+        self.pending = 0
+    def submit(self, fname, trial):
+        """Queue the checkpoint `fname` (saved after `trial` trials)."""
+        if self.process is None:
+            self.tasks = multiprocessing.Queue()
+            self.results = multiprocessing.Queue()
+            self.process = multiprocessing.Process(target=validate_worker, args=self.args+(
+                self.tasks, self.results), daemon=True)
+            self.process.start()
+        self.tasks.put((fname, trial))
+        self.pending += 1
+    def poll(self, wait=False):
+        """Handle the results of all finished validations (or, if `wait`,
+        of all pending ones). Returns whether training should stop."""
+        while self.pending:
+            try:
+                fname, trial, cer = self.results.get(block=wait, timeout=10)
+            except queue.Empty:
+                if not wait:
+                    break
+                if not self.process.is_alive():
+                    print("# validation process died, giving up on", self.pending, "validations")
+                    self.pending = 0
+                continue
+            self.pending -= 1
+            print("# validation CER %.3f%% after %d trials (%s)" % (100*cer, trial, fname))
+            if cer<self.best_cer:
+                self.best_cer = cer
+                self.bad = 0
+                print("# new best, copying to", self.best)
+                shutil.copyfile(fname, self.best)
+            else:
+                self.bad += 1
+        return self.patience>0 and self.bad>=self.patience
+    def close(self):
+        """Wait for all pending validations, then end the background process."""
+        if self.process is None:
+            return
+        self.poll(wait=True)
+        self.tasks.put(None)
+        self.process.join()
+
+def rollback(network, snapshot):
+    """Restore the weights of `network` from the flat array `snapshot`
+    (see `get_weights`) after a FloatingPointError, and discard the
+    momentum of the weight updates."""
+    set_weights(network, snapshot)
+    network.lstm.deltas = None
+
+def train_worker(worker, num_workers, network, codec, cache, pad, indexes, start, ntrain,
+                 batch_size, sync_steps, savefreq, oname, shm_name, barrier, quiet,
+                 rollbacks, sampler='uniform', seed=0, validator=None, stop=None):
+    """Train one replica of `network` in data-parallel training (see `rtrain`).
+
+    The trials are processed in rounds of `sync_steps` weight updates per
+    worker, where each worker takes its own part of the trials of the round,
+    sampling from its own part of the lines (with its own `sampler`,
+    seeded with `seed` plus its number). After each round, all workers
+    average their weights through the shared memory `shm_name` (one row of
+    weights per worker, plus one for the average). On a FloatingPointError,
+    a worker rolls back to the last average (counted in the shared
+    `rollbacks`). The first worker also
+    saves the checkpoints, and (with a `validator`) has them validated,
+    setting the shared flag `stop` for all workers to stop early.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        nweights = sum(w.size for w,_,_ in network.lstm.weights())
+        weights = np.ndarray((num_workers+1,nweights),dtype=np.float64,buffer=shm.buf)
+        lines = LineShard(cache, pad=pad)
+        sampler = SAMPLERS[sampler](indexes[worker::num_workers], np.diff(lines.offsets),
+                                    batch_size, seed=seed+worker)
+        batches = iter(sampler)
+        size = sync_steps*batch_size*num_workers
+        writer = CheckpointWriter(validator) if worker==0 else None
+        for first in range(start, ntrain, size):
+            last = min(ntrain, first+size)
+            # this worker's part of the trials in this round
+            part = -(-(last-first)//num_workers)
+            end = min(last, first+(worker+1)*part)
+            # (count the lines actually drawn, as the last batch of an epoch can be short)
+            trial = first+worker*part
+            while trial<end:
+                chosen = next(batches)[:end-trial]
+                batch = [lines[i] for i in chosen]
+                try:
+                    sampler.update(chosen, train_lines(network, codec, batch, trial, quiet=quiet))
+                except FloatingPointError as e:
+                    with rollbacks.get_lock():
+                        rollbacks.value += 1
+                    print("# oops, got FloatingPointError in worker", worker, e)
+                    traceback.print_exc()
+                    # restart from the last average
+                    rollback(network, weights[num_workers])
+                trial += len(chosen)
+            # average the weights of all workers
+            get_weights(network, weights[worker])
+            if worker==0:
+                writer.poll()
+                if validator and validator.poll():
+                    stop.value = 1
+            barrier.wait()
+            set_weights(network, np.mean(weights[:num_workers],axis=0))
+            if worker==0:
+                # keep the average to roll back to; this must happen before
+                # the next barrier, as afterwards other workers may read it
+                get_weights(network, weights[num_workers])
+            barrier.wait()
+            network.last_trial = last
+            if worker==0:
+                if last//savefreq>first//savefreq:
+                    ofile = oname%(last//savefreq*savefreq)+".gz"
+                    print("# saving", ofile)
+                    writer.save(ofile, network, last)
+                    sampler.report()
+            if stop is not None and stop.value:
+                if worker==0:
+                    print("# no improvement in", validator.patience, "validations, stopping")
+                break
+        if worker==0:
+            sampler.report()
+            writer.close()
+            if validator:
+                validator.close()
+    except BaseException:
+        # do not leave the other workers waiting
+        barrier.abort()
+        raise
+    finally:
+        shm.close()
+
+def rtrain(inputs, load, output, ntrain, cache=None, batch_size=1, num_workers=1, sync_steps=100,
+           validation=0.0, patience=10, sampler='uniform', seed=0):
 
     #defaultvalues
     #extra blank padding to the left and right of text line, default: 16
@@ -85,16 +644,11 @@ def rtrain(inputs, load, output, ntrain):
     # Somewhat convoluted logic for dealing with old style Python
     # modules and new style C++ LSTM networks.
 
-    def save_lstm(fname,network):
+    def save_lstm(fname,network,trial):
         if argclstm:
             network.lstm.save(fname)
         else:
-            if strip:
-                network.clear_log()
-                for x in network.walk(): x.preSave()
-            ocrolib.save_object(fname,network)
-            if strip:
-                for x in network.walk(): x.postLoad()
+            writer.save(fname,network,trial)
 
 
     def load_lstm(fname):
@@ -109,17 +663,15 @@ def rtrain(inputs, load, output, ntrain):
             network.lstm = clstm.CNetwork(mylstm)
             return network
         else:
-            network = ocrolib.load_object(last_save)
+            network = ocrolib.load_object(fname)
             network.upgrade()
             for x in network.walk(): x.postLoad()
             return network
 
     if load:
         print("# loading", load)
-        last_save = load
         network = load_lstm(load)
     else:
-        last_save = None
         network = lstm.SeqRecognizer(height,hiddensize,
             codec=codec,
             normalize=lstm.normalize_nfkc)
@@ -136,65 +688,108 @@ def rtrain(inputs, load, output, ntrain):
     if network.last_trial%100==99: network.last_trial += 1
     print("# last_trial", network.last_trial)
 
+    # normalize all lines once (or re-use the shard from a previous run)
+    if cache is None:
+        cache = oname.split("%")[0].rstrip("-")+"-lines.npz"
+    if shard_current(cache, inputs, network.lnorm, codec):
+        print("# using prepared lines from", cache)
+    else:
+        prepare_lines(inputs, network.lnorm, codec, cache)
+    lines = LineShard(cache, pad=pad)
+    if len(lines)==0:
+        print("no usable training lines")
+        return
+
 
     # set up the learning rate
     network.setLearningRate(lrate,0.9)
 
     start = start if start>=0 else network.last_trial
 
-    for trial in range(start,ntrain):
-        network.last_trial = trial+1
-
-        do_update = 1
-
-        fname = pyrandom.sample(inputs,1)[0]
-        # print(inputs)
-        # fname = inputs[0]
-        # print(fname)
-
-        base,_ = ocrolib.allsplitext(fname)
-
-        line = ocrolib.read_image_gray(fname)
-        transcript = ocrolib.read_text(base+".gt.txt")
-
-
-
-        network.lnorm.measure(np.amax(line)-line)
-        line = network.lnorm.normalize(line,cval=np.amax(line))
-
-        if line.size<10 or np.amax(line)==np.amin(line):
-            print("EMPTY-INPUT")
-            continue
-        line = line * 1.0/np.amax(line)
-        line = np.amax(line)-line
-        line = line.T
-        if pad>0:
-            w = line.shape[1]
-            line = np.vstack([np.zeros((pad,w)),line,np.zeros((pad,w))])
-        cs = np.array(codec.encode(transcript),'i')
+    # hold out some lines to validate the checkpoints on
+    indexes = range(len(lines))
+    validator = None
+    nvalid = int(round(validation*len(lines)))
+    if 0<nvalid<len(lines):
+        heldout = sorted(pyrandom.Random(seed).sample(indexes,nvalid))
+        indexes = sorted(set(indexes)-set(heldout))
+        best = oname.split("%")[0].rstrip("-")+"-best.pyrnn.gz"
+        print("# validating on", nvalid, "held-out lines, keeping the best checkpoint in", best)
+        validator = Validator(cache, heldout, pad, best, patience)
+
+    print("# sampling lines with the", sampler, "sampler, seed", seed)
+
+    if num_workers>1:
+        num_workers = min(num_workers,len(indexes))
+        print("# training with", num_workers, "workers, averaging every", sync_steps, "updates")
+        nweights = sum(w.size for w,_,_ in network.lstm.weights())
+        shm = shared_memory.SharedMemory(create=True,size=(num_workers+1)*nweights*8)
         try:
-            pcs = network.trainSequence(line,cs,update=do_update,key=fname)
+            weights = np.ndarray((num_workers+1,nweights),dtype=np.float64,buffer=shm.buf)
+            get_weights(network, weights[num_workers])
+            barrier = multiprocessing.Barrier(num_workers)
+            stop = multiprocessing.Value('b',0)
+            rollbacks = multiprocessing.Value('i',0)
+            workers = [multiprocessing.Process(target=train_worker, args=(
+                worker, num_workers, network, codec, cache, pad, indexes, start, ntrain,
+                batch_size, sync_steps, savefreq, oname, shm.name, barrier, quiet,
+                rollbacks, sampler, seed, validator, stop))
+                       for worker in range(num_workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if any(worker.exitcode for worker in workers):
+                raise Exception("training failed in some worker process")
+            set_weights(network, weights[num_workers])
+            network.last_trial = max(start,ntrain)
+            print("# rolled back", rollbacks.value, "times after FloatingPointError")
+        finally:
+            shm.close()
+            shm.unlink()
+        return
+
+    # keep the weights of the last checkpoint to roll back to
+    nweights = sum(w.size for w,_,_ in network.lstm.weights())
+    snapshot = np.empty(nweights)
+    get_weights(network, snapshot)
+    rollbacks = 0
+    writer = CheckpointWriter(validator, strip=strip)
+    sampler = SAMPLERS[sampler](indexes, np.diff(lines.offsets), batch_size, seed=seed)
+    batches = iter(sampler)
+
+    # (count the lines actually drawn, as the last batch of an epoch can be short)
+    trial = start
+    while trial<ntrain:
+        chosen = next(batches)[:ntrain-trial]
+        first, trial = trial, trial+len(chosen)
+        network.last_trial = trial
+
+        batch = [lines[i] for i in chosen]
+        try:
+            sampler.update(chosen, train_lines(network, codec, batch, first, quiet=quiet))
         except FloatingPointError as e:
+            rollbacks += 1
             print("# oops, got FloatingPointError", e)
             traceback.print_exc()
-            network = load_lstm(last_save)
+            rollback(network, snapshot)
             continue
         except lstm.RangeError as e:
             continue
-        pred = "".join(codec.decode(pcs))
-        acs = lstm.translate_back(network.aligned)
-        gta = "".join(codec.decode(acs))
-        if not quiet:
-            print("%d %.2f %s" % (trial, network.error, line.shape), fname)
-            print("   TRU:", repr(transcript))
-            print("   ALN:", repr(gta[:len(transcript)+5]))
-            print("   OUT:", repr(pred[:len(transcript)+5]))
-
-        pred = re.sub(' ','_',pred)
-        gta = re.sub(' ','_',gta)
 
-        if (trial+1)%savefreq==0:
-            ofile = oname%(trial+1)+".gz"
+        if trial//savefreq>first//savefreq:
+            ofile = oname%(trial//savefreq*savefreq)+".gz"
             print("# saving", ofile)
-            save_lstm(ofile,network)
-            last_save = ofile
+            save_lstm(ofile,network,trial)
+            get_weights(network, snapshot)
+            print("# rolled back", rollbacks, "times so far after FloatingPointError")
+            sampler.report()
+        writer.poll()
+        if validator and validator.poll():
+            print("# no improvement in", patience, "validations, stopping")
+            break
+    sampler.report()
+    writer.close()
+    if validator:
+        validator.close()
+    print("# rolled back", rollbacks, "times after FloatingPointError")
@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from logging import Logger
+from queue import Queue
 from sys import exit
 from typing import Any, Optional
-from os import access, R_OK
-from os.path import abspath, dirname, isfile, join
+from os import access, stat, R_OK
+from os.path import abspath, dirname, isfile, join, realpath
 import numpy as np
 from PIL import Image
 
@@ -18,6 +21,41 @@ from .common import check_line, pil2array
 from .ocrolib import lstm, load_object, midrange
 
 
+def load_network(path, precision='float64'):
+    """Load an Ocropy model for recognition, converting it to ``precision``."""
+    # from ocropus-rpred:
+    network = load_object(path, verbose=1)
+    for x in network.walk():
+        if isinstance(x, lstm.LSTM):
+            # only allocate (on demand) what forward propagation needs
+            x.allocate(5000, inference=True)
+        else:
+            x.postLoad()
+    if precision != 'float64':
+        for x in network.walk():
+            x.setPrecision(precision)
+    return network
+
+@lru_cache(maxsize=4)
+def load_network_cached(path, mtime, precision):
+    """Load an Ocropy model like ``load_network``, but keep the last few
+    loaded networks in a process-wide cache (keyed by resolved path,
+    modification time and precision). Use ``.cache_info()`` to get the
+    number of hits and misses.
+
+    The networks are shared, so use their ``replicate()`` for recognition.
+    """
+    return load_network(path, precision=precision)
+
+def get_network(path, precision='float64'):
+    """Get a recognizer for the model at ``path`` from the model cache.
+
+    Returns a replica with its own internal state (sharing the weights).
+    """
+    path = realpath(path)
+    network = load_network_cached(path, stat(path).st_mtime_ns, precision)
+    return network.replicate()
+
 def resize_keep_ratio(image, baseheight=48):
     scale = baseheight / image.height
     wsize = round(image.width * scale)
@@ -25,10 +63,9 @@ def resize_keep_ratio(image, baseheight=48):
     return image, scale
 
 # from ocropus-rpred process1, but without input files and without lineest/dewarping
-def recognize(image, pad, network, check=True):
+def preprocess(image, pad, check=True):
     line = pil2array(image)
     binary = np.array(line <= midrange(line), np.uint8)
-    raw_line = line.copy()
 
     # validate:
     if np.prod(line.shape) == 0:
@@ -36,37 +73,97 @@ def recognize(image, pad, network, check=True):
     if np.amax(line) == np.amin(line):
         raise Exception('image is blank')
     if check:
-        report = check_line(binary)
+        # long lines get recognized in chunks (see SeqRecognizer.predictSequence)
+        report = check_line(binary, maxwidth=None)
         if report:
             raise Exception(report)
 
-    # recognize:
-    line = lstm.prepare_line(line, pad)
-    pred = network.predictString(line)
-
-    # getting confidence
-    result = lstm.translate_back(network.outputs, pos=1)
-    scale = len(raw_line.T) * 1.0 / (len(network.outputs) - 2 * pad)
-
-    clist = []
-    rlist = []
-    confidlist = []
+    return lstm.prepare_line(line, pad), line.shape[1]
 
-    for r, c in result:
-        if c != 0:
-            confid = network.outputs[r, c]
-            c = network.l2s([c])
-            r = (r - pad) * scale
+def decode(outputs, pad, width, network):
+    classes, positions, confids = lstm.ctc_decode(outputs)
+    pred = network.l2s(classes)
 
-            confidlist.append(confid)
-            clist.append(c)
-            rlist.append(r)
+    # getting confidence
+    scale = width * 1.0 / (len(outputs) - 2 * pad)
+    chars = classes != 0
+    clist = network.codec.decode(classes[chars])
+    rlist = ((positions[chars] - pad) * scale).tolist()
+    confidlist = confids[chars].tolist()
 
     return str(pred), clist, rlist, confidlist
 
+def recognize(image, pad, network, check=True):
+    line, width = preprocess(image, pad, check=check)
+    network.predictSequence(line)
+    return decode(network.outputs, pad, width, network)
+
+def schedule_batches(widths, batch_size, max_columns=0):
+    """Group lines into batches of similar width to minimize padding.
+
+    Sort the lines by their ``widths``, then fill each batch with up to
+    ``batch_size`` lines, as long as the padded size (number of lines times
+    the widest line) stays within ``max_columns`` (unless 0). Lines wider
+    than that get a batch of their own.
+
+    Returns a list of batches, each a list of indexes into ``widths``.
+    """
+    batches = []
+    batch = []
+    for i in np.argsort(widths, kind='stable'):
+        if batch and (len(batch) >= batch_size or
+                      max_columns and (len(batch) + 1) * widths[i] > max_columns):
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
+
+def recognize_batch(images, pad, network, check=True):
+    """Recognize a list of line images at once, padded into a single batch.
+
+    Returns a list with the result of ``recognize`` for each image, or
+    the exception raised for it, in the original order.
+    """
+    results = [None] * len(images)
+    indexes, lines, widths = [], [], []
+    for i, image in enumerate(images):
+        try:
+            line, width = preprocess(image, pad, check=check)
+        except Exception as err:
+            results[i] = err
+            continue
+        indexes.append(i)
+        lines.append(line)
+        widths.append(width)
+    if not lines:
+        return results
+    try:
+        outputs = network.predictBatch(lines)
+    except lstm.RecognitionError:
+        # some line is too long for the batch, so fall back to single lines
+        outputs = []
+        for line in lines:
+            try:
+                network.predictSequence(line)
+                outputs.append(network.outputs)
+            except Exception as err:
+                outputs.append(err)
+    for i, output, width in zip(indexes, outputs, widths):
+        if isinstance(output, Exception):
+            results[i] = output
+            continue
+        try:
+            results[i] = decode(output, pad, width, network)
+        except Exception as err:
+            results[i] = err
+    return results
+
 
 class OcropyRecognize(Processor):
     network: Any
+    networks: Queue
     pad: int
 
     @property
@@ -75,13 +172,13 @@ class OcropyRecognize(Processor):
 
     def setup(self):
         self.pad = 16
-        # from ocropus-rpred:
-        self.network = load_object(self.get_model(), verbose=1)
-        for x in self.network.walk():
-            x.postLoad()
-        for x in self.network.walk():
-            if isinstance(x, lstm.LSTM):
-                x.allocate(5000)
+        self.network = get_network(self.get_model(), precision=self.parameter['precision'])
+        self.logger.info(f"Model cache: {load_network_cached.cache_info()}")
+        # one network replica (sharing the weights) for each worker thread
+        self.networks = Queue()
+        self.networks.put(self.network)
+        for _ in range(self.parameter['num_workers'] - 1):
+            self.networks.put(self.network.replicate())
 
     def get_model(self):
         """Search for the model file.  First checks if parameter['model'] can
@@ -115,7 +212,8 @@ class OcropyRecognize(Processor):
         Set up Ocropy to recognize each text line (via coordinates into
         the higher-level image, or from the alternative image; the image
         must have been binarized/grayscale-normalised, deskewed and dewarped
-        already). Rescale and pad the image, then recognize.
+        already). Rescale and pad the image, then recognize (collecting up
+        to ``batch_size`` lines of the page into one padded batch).
 
         Create new elements below the line level, if necessary.
         Put text results and confidence values into new TextEquiv at
@@ -149,110 +247,165 @@ class OcropyRecognize(Processor):
     def process_regions(self, regions, maxlevel, page_image, page_xywh):
         edits = 0
         lengs = 0
+        lines = []
         for region in regions:
             region_image, region_xywh = self.workspace.image_from_segment(region, page_image, page_xywh)
             self.logger.info(f"Recognizing text in region '{region.id}'")
             textlines = region.get_TextLine()
             if not textlines:
                 self.logger.warning(f"Region '{region.id}' contains no text lines")
-            else:
-                edits_, lengs_ = self.process_lines(textlines, maxlevel, region_image, region_xywh)
-                edits += edits_
-                lengs += lengs_
+            for line in textlines:
+                extracted = self.extract_line(line, region_image, region_xywh)
+                if extracted:
+                    lines.append(extracted)
+        results = self.recognize_lines([final_img for _, _, _, final_img, _, _ in lines])
+        for (line, line_image, line_coords, _, scale, linegt), result in zip(lines, results):
+            if isinstance(result, Exception):
+                self.logger.debug(f'Error processing line "{line.id}": {result}')
+                continue
+            linepred = result[0]
+            self.logger.debug(f"OCR '{line.id}': '{linepred}'")
+            edits += Levenshtein.distance(linepred, linegt)
+            lengs += len(linegt)
+            self.annotate_line(line, maxlevel, line_image, line_coords, scale, result)
+        for region in regions:
             # update region text by concatenation for consistency
             region_unicode = u'\n'.join(
-                line.get_TextEquiv()[0].Unicode if line.get_TextEquiv() else u'' for line in textlines)
+                line.get_TextEquiv()[0].Unicode if line.get_TextEquiv() else u'' for line in region.get_TextLine())
             region.set_TextEquiv([TextEquivType(Unicode=region_unicode)])
         if lengs > 0:
             self.logger.info('CER: %.1f%%', 100.0 * edits / lengs)
 
-    def process_lines(self, textlines, maxlevel, region_image, region_xywh):
-        edits = 0
-        lengs = 0
-        for line in textlines:
-            line_image, line_coords = self.workspace.image_from_segment(line, region_image, region_xywh)
-            self.logger.info(f"Recognizing text in line '{line.id}'")
-            if line.get_TextEquiv():
-                linegt = line.TextEquiv[0].Unicode
-            else:
-                linegt = ''
-            self.logger.debug(f"GT  '{line.id}': '{linegt}'")
-            # remove existing annotation below line level:
-            line.set_TextEquiv([])
-            line.set_Word([])
-
-            if line_image.size[1] < 16:
-                self.logger.debug(f"Error: bounding box is too narrow at line {line.id}")
-                continue
-            # resize image to 48 pixel height
-            final_img, scale = resize_keep_ratio(line_image)
+    def extract_line(self, line, region_image, region_xywh):
+        """Crop and rescale the image of a text line for recognition.
 
-            # process ocropy:
+        Remove any existing annotation below the line level.
+
+        Return a tuple of the line, its image and coordinates, the rescaled
+        image, the scale factor, and the previous text, or None if unusable.
+        """
+        line_image, line_coords = self.workspace.image_from_segment(line, region_image, region_xywh)
+        self.logger.info(f"Recognizing text in line '{line.id}'")
+        if line.get_TextEquiv():
+            linegt = line.TextEquiv[0].Unicode
+        else:
+            linegt = ''
+        self.logger.debug(f"GT  '{line.id}': '{linegt}'")
+        # remove existing annotation below line level:
+        line.set_TextEquiv([])
+        line.set_Word([])
+
+        if line_image.size[1] < 16:
+            self.logger.debug(f"Error: bounding box is too narrow at line {line.id}")
+            return None
+        # resize image to 48 pixel height
+        final_img, scale = resize_keep_ratio(line_image)
+        return line, line_image, line_coords, final_img, scale, linegt
+
+    def recognize_lines(self, images):
+        """Recognize a list of (rescaled) line images with Ocropy.
+
+        Unless ``batch_size`` is 1, pad up to that many lines (of similar
+        width, up to ``batch_columns`` in total) into a single batch for
+        the network. Unless ``num_workers`` is 1, recognize that many lines
+        (or batches) concurrently.
+
+        Return the results of ``recognize`` for each line (or the
+        exception raised for it) in the original order.
+        """
+        if not images:
+            return []
+        widths = [image.width + 2 * self.pad for image in images]
+        batches = schedule_batches(widths, self.parameter['batch_size'],
+                                   self.parameter['batch_columns'])
+        computed = sum(len(batch) * widths[batch[-1]] for batch in batches)
+        self.logger.info(f"Recognizing {len(images)} lines in {len(batches)} batches "
+                         f"(padding efficiency: {100.0 * sum(widths) / computed:.1f}%)")
+        batch_images = [[images[i] for i in batch] for batch in batches]
+        num_workers = self.parameter['num_workers']
+        if num_workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                batch_results = list(pool.map(self.recognize_batch, batch_images))
+        else:
+            batch_results = list(map(self.recognize_batch, batch_images))
+        # restore the original order of the lines
+        results = [None] * len(images)
+        for batch, batch_result in zip(batches, batch_results):
+            for i, result in zip(batch, batch_result):
+                results[i] = result
+        return results
+
+    def recognize_batch(self, images):
+        """Recognize a batch of line images with the next free network replica."""
+        network = self.networks.get()
+        try:
+            if len(images) > 1:
+                return recognize_batch(images, self.pad, network, check=True)
             try:
-                linepred, clist, rlist, confidlist = recognize(final_img, self.pad, self.network, check=True)
+                return [recognize(images[0], self.pad, network, check=True)]
             except Exception as err:
-                self.logger.debug(f'Error processing line "{line.id}": {err}')
-                continue
-            self.logger.debug(f"OCR '{line.id}': '{linepred}'")
-            edits += Levenshtein.distance(linepred, linegt)
-            lengs += len(linegt)
-
-            words = [x.strip() for x in linepred.split(' ') if x.strip()]
-
-            word_r_list = [[0]]  # r-positions of every glyph in every word
-            word_conf_list = [[]]  # confidences of every glyph in every word
-            if words != []:
-                w_no = 0
-                found_char = False
-                for i, c in enumerate(clist):
-                    if c != ' ':
-                        found_char = True
-                        word_conf_list[w_no].append(confidlist[i])
-                        word_r_list[w_no].append(rlist[i])
-                    if c == ' ' and found_char:
-                        if i == 0:
-                            word_r_list[0][0] = rlist[i]
-                        elif i + 1 <= len(clist) - 1 and clist[i + 1] != ' ':
-                            word_conf_list.append([])
-                            word_r_list.append([rlist[i]])
-                            w_no += 1
-            else:
-                word_conf_list = [[0]]
-                word_r_list = [[0, line_image.width]]
-
-            # conf for each word
-            wordsconf = [(min(x) + max(x)) / 2 for x in word_conf_list]
-            # conf for the line
-            line_conf = (min(wordsconf) + max(wordsconf)) / 2
-            # line text
-            line.add_TextEquiv(TextEquivType(Unicode=linepred, conf=line_conf))
-
-            if maxlevel in ['word', 'glyph']:
-                for word_no, word_str in enumerate(words):
-                    word_points = points_from_polygon(
-                        coordinates_for_segment(
-                            np.array(polygon_from_bbox(
-                                word_r_list[word_no][0] / scale,0,
-                                word_r_list[word_no][-1] / scale, 0 + line_image.height)),
-                            line_image,
-                            line_coords))
-                    word_id = '%s_word%04d' % (line.id, word_no)
-                    word = WordType(id=word_id, Coords=CoordsType(word_points))
-                    line.add_Word(word)
-                    word.add_TextEquiv(TextEquivType(Unicode=word_str, conf=wordsconf[word_no]))
-
-                    if maxlevel == 'glyph':
-                        for glyph_no, glyph_str in enumerate(word_str):
-                            glyph_points = points_from_polygon(
-                                coordinates_for_segment(
-                                    np.array(polygon_from_bbox(
-                                        word_r_list[word_no][glyph_no] / scale, 0,
-                                        word_r_list[word_no][glyph_no + 1] / scale, 0 + line_image.height)),
-                                    line_image,
-                                    line_coords))
-                            glyph_id = '%s_glyph%04d' % (word.id, glyph_no)
-                            glyph = GlyphType(id=glyph_id, Coords=CoordsType(glyph_points))
-                            word.add_Glyph(glyph)
-                            glyph.add_TextEquiv(
-                                TextEquivType(Unicode=glyph_str, conf=word_conf_list[word_no][glyph_no]))
-        return edits, lengs
+                return [err]
+        finally:
+            self.networks.put(network)
+
+    def annotate_line(self, line, maxlevel, line_image, line_coords, scale, result):
+        linepred, clist, rlist, confidlist = result
+
+        words = [x.strip() for x in linepred.split(' ') if x.strip()]
+
+        word_r_list = [[0]]  # r-positions of every glyph in every word
+        word_conf_list = [[]]  # confidences of every glyph in every word
+        if words != []:
+            w_no = 0
+            found_char = False
+            for i, c in enumerate(clist):
+                if c != ' ':
+                    found_char = True
+                    word_conf_list[w_no].append(confidlist[i])
+                    word_r_list[w_no].append(rlist[i])
+                if c == ' ' and found_char:
+                    if i == 0:
+                        word_r_list[0][0] = rlist[i]
+                    elif i + 1 <= len(clist) - 1 and clist[i + 1] != ' ':
+                        word_conf_list.append([])
+                        word_r_list.append([rlist[i]])
+                        w_no += 1
+        else:
+            word_conf_list = [[0]]
+            word_r_list = [[0, line_image.width]]
+
+        # conf for each word
+        wordsconf = [(min(x) + max(x)) / 2 for x in word_conf_list]
+        # conf for the line
+        line_conf = (min(wordsconf) + max(wordsconf)) / 2
+        # line text
+        line.add_TextEquiv(TextEquivType(Unicode=linepred, conf=line_conf))
+
+        if maxlevel in ['word', 'glyph']:
+            for word_no, word_str in enumerate(words):
+                word_points = points_from_polygon(
+                    coordinates_for_segment(
+                        np.array(polygon_from_bbox(
+                            word_r_list[word_no][0] / scale,0,
+                            word_r_list[word_no][-1] / scale, 0 + line_image.height)),
+                        line_image,
+                        line_coords))
+                word_id = '%s_word%04d' % (line.id, word_no)
+                word = WordType(id=word_id, Coords=CoordsType(word_points))
+                line.add_Word(word)
+                word.add_TextEquiv(TextEquivType(Unicode=word_str, conf=wordsconf[word_no]))
+
+                if maxlevel == 'glyph':
+                    for glyph_no, glyph_str in enumerate(word_str):
+                        glyph_points = points_from_polygon(
+                            coordinates_for_segment(
+                                np.array(polygon_from_bbox(
+                                    word_r_list[word_no][glyph_no] / scale, 0,
+                                    word_r_list[word_no][glyph_no + 1] / scale, 0 + line_image.height)),
+                                line_image,
+                                line_coords))
+                        glyph_id = '%s_glyph%04d' % (word.id, glyph_no)
+                        glyph = GlyphType(id=glyph_id, Coords=CoordsType(glyph_points))
+                        word.add_Glyph(glyph)
+                        glyph.add_TextEquiv(
+                            TextEquivType(Unicode=glyph_str, conf=word_conf_list[word_no][glyph_no]))
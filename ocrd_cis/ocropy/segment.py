@@ -2,9 +2,11 @@ from __future__ import absolute_import
 
 from typing import Optional
 from logging import Logger
+from concurrent.futures import ThreadPoolExecutor
 import itertools
 
 import numpy as np
+from scipy.ndimage import find_objects
 from scipy.sparse.csgraph import minimum_spanning_tree
 from skimage import draw
 from skimage.morphology import convex_hull_image
@@ -18,6 +20,7 @@ from shapely import set_precision
 from ocrd_utils import (
     coordinates_of_segment,
     coordinates_for_segment,
+    scale_coordinates,
     points_from_polygon,
     polygon_from_points,
 )
@@ -47,11 +50,15 @@ from ocrd.processor import OcrdPageResult, OcrdPageResultImage
 
 from .ocrolib import midrange
 from .ocrolib import morph
+from . import common
 from .common import (
+    available_cpus,
     pil2array,
     array2pil,
     check_page, check_region,
     determine_zoom,
+    downscale_binary,
+    upscale_labels,
     hmerge_line_seeds,
     compute_segmentation,
     lines2regions
@@ -71,6 +78,8 @@ def masks2polygons(logger: Logger, bg_labels, baselines, fg_bin, name, min_area=
     Each contour part which is not too small and gives a
     (simplified) polygon of at least 4 points becomes a polygon.
     (Thus, labels can be split into multiple polygons.)
+    Labels are processed within their bounding box (in parallel threads,
+    if ``OCROPY_STRIPS_THREADS`` allows several on the available CPUs).
 
     Return a tuple:
     - these polygons as a list of label, polygon, baseline tuples, and
@@ -84,21 +93,21 @@ def masks2polygons(logger: Logger, bg_labels, baselines, fg_bin, name, min_area=
         baselines = [LineString(sorted([p[::-1] for p in line], key=getx)).simplify(5)
                      for line in baselines
                      if len(line) >= 2]
-    results = list()
-    result_labels = np.zeros_like(bg_labels, dtype=bg_labels.dtype)
-    for label in np.unique(bg_labels):
-        if not label:
-            # ignore if background
-            continue
-        bg_mask = np.array(bg_labels == label, bool)
-        if not np.count_nonzero(bg_mask * fg_bin):
-            # ignore if missing foreground
-            logger.debug(f'Skipping label {label} in {name} due to empty fg')
-            continue
+    # count the foreground pixels of all labels at once
+    fg_counts = np.bincount(bg_labels[fg_bin != 0].ravel(), minlength=np.amax(bg_labels) + 1)
+
+    def label2polygons(label, box):
+        # process only within the bounding box of the label
+        # (plus 1px margin, so contours are the same as on the full image)
+        box = tuple(slice(max(0, sl.start - 1), min(size, sl.stop + 1))
+                    for sl, size in zip(box, bg_labels.shape))
+        offset = (box[1].start, box[0].start)
+        polygons = list()
+        bg_mask = np.array(bg_labels[box] == label, bool)
         # simplify to convex hull
         if simplify is not None:
             hull = convex_hull_image(bg_mask.astype(np.uint8)).astype(bool)
-            conflicts = np.setdiff1d(hull * simplify, bg_mask * simplify)
+            conflicts = np.setdiff1d(hull * simplify[box], bg_mask * simplify[box])
             if conflicts.any():
                 logger.debug(
                     f'Cannot simplify {label}: convex hull would create additional intersections {str(conflicts)}')
@@ -115,7 +124,8 @@ def masks2polygons(logger: Logger, bg_labels, baselines, fg_bin, name, min_area=
             #     plt.show()
             # find outer contour (parts) plus direct holes (if any)
             contours = []
-            cont, hier = cv2.findContours(bg_mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+            cont, hier = cv2.findContours(bg_mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE,
+                                          offset=offset)
             idx = 0
             while idx >= 0:
                 contour = cont[idx]
@@ -186,17 +196,19 @@ def masks2polygons(logger: Logger, bg_labels, baselines, fg_bin, name, min_area=
                 idx = hier[0, idx, 0]
         else:
             # find outer contour (parts):
-            contours, _ = cv2.findContours(bg_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours, _ = cv2.findContours(bg_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                           offset=offset)
         # determine areas of parts:
         areas = [cv2.contourArea(contour) for contour in contours]
         total_area = sum(areas)
         if not total_area:
             # ignore if too small
-            continue
+            return polygons
         # redraw label array
         contour_labels = np.zeros_like(bg_mask, np.uint8)
         for i, contour in enumerate(contours):
-            cv2.drawContours(contour_labels, contours, i, i+1, cv2.FILLED)
+            cv2.drawContours(contour_labels, contours, i, i+1, cv2.FILLED,
+                             offset=(-offset[0], -offset[1]))
         if reorder:
             # sort contours in reading order
             order = np.argsort(morph.reading_order(contour_labels)[1:])
@@ -236,8 +248,30 @@ def masks2polygons(logger: Logger, bg_labels, baselines, fg_bin, name, min_area=
                     base = base.coords
             else:
                 base = None
+            polygons.append((poly, base, box, contour_labels == i + 1))
+        return polygons
+
+    labels = list()
+    for label, box in enumerate(find_objects(bg_labels), 1):
+        if box is None:
+            continue
+        if not fg_counts[label]:
+            # ignore if missing foreground
+            logger.debug(f'Skipping label {label} in {name} due to empty fg')
+            continue
+        labels.append((label, box))
+    results = list()
+    result_labels = np.zeros_like(bg_labels, dtype=bg_labels.dtype)
+    num_workers = min(common.STRIPS_THREADS, available_cpus(), len(labels))
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            label_polygons = list(pool.map(lambda args: label2polygons(*args), labels))
+    else:
+        label_polygons = [label2polygons(*args) for args in labels]
+    for (label, _), polygons in zip(labels, label_polygons):
+        for poly, base, box, mask in polygons:
             results.append((label, poly, base))
-            result_labels[contour_labels == i + 1] = len(results)
+            result_labels[box][mask] = len(results)
     return results, result_labels
 
 
@@ -503,12 +537,30 @@ class OcropySegment(Processor):
         in any of those segments' coordinates during segmentation, and if also
         in full page/table mode, then combine all separators among them with the
         newly detected separators to guide region segmentation.
+
+        If ``downscale`` is positive and smaller than the pixel density
+        of the image, then segment a reduced copy of the image instead,
+        and map all results back via the coordinate transform.
         """
         if not image.width or not image.height:
             self.logger.warning(f"Skipping '{element.id}' with zero size")
             return None
         element_array = pil2array(image)
         element_bin = np.array(element_array <= midrange(element_array), bool)
+        downscale = self.parameter['downscale']
+        if downscale > 0 and zoom * downscale < 300:
+            # segment at reduced pixel density to save time;
+            # all results get mapped back to the original image
+            # via the (scaled) coordinate transform
+            factor = zoom * downscale / 300
+            size = (max(1, round(image.width * factor)),
+                    max(1, round(image.height * factor)))
+            self.logger.debug(f'Downscaling "{element.id}" from {image.width}x{image.height} '
+                              f'to {size[0]}x{size[1]} ({downscale} DPI)')
+            element_bin = downscale_binary(element_bin, size)
+            coords = dict(coords, transform=scale_coordinates(
+                coords['transform'], (size[0] / image.width, size[1] / image.height)))
+            zoom = 300.0 / downscale
         sep_bin = np.zeros_like(element_bin, bool)
         ignore_labels = np.zeros_like(element_bin, int)
         for i, segment in enumerate(ignore):
@@ -549,7 +601,6 @@ class OcropySegment(Processor):
             suffix = f"{element.id}.IMG-CLIP"
         element_name_id = f'{element_name} "{element.id}"'
         self.logger.info(f'Computing line segmentation for {element_name_id}')
-        # TODO: we should downscale if DPI is large enough to save time
         try:
             if report:
                 raise Exception(report)
@@ -727,7 +778,7 @@ class OcropySegment(Processor):
                 element.add_SeparatorRegion(SeparatorRegionType(
                     id=region_id, Coords=CoordsType(points=points_from_polygon(region_polygon))))
             # annotate a text/image-separated image
-            element_array[sepmask] = np.amax(element_array)  # clip to white/bg
+            element_array[upscale_labels(sepmask, element_array.shape)] = np.amax(element_array)  # clip to white/bg
             image_clipped = array2pil(element_array)
             image_ref = AlternativeImageType(comments=coords['features'] + ',clipped')
             element.add_AlternativeImage(image_ref)
@@ -762,7 +813,7 @@ class OcropySegment(Processor):
             if not sep_bin.any():
                 return None  # no derived image
             # annotate a text/image-separated image
-            element_array[sep_bin] = np.amax(element_array)  # clip to white/bg
+            element_array[upscale_labels(sep_bin, element_array.shape)] = np.amax(element_array)  # clip to white/bg
             image_clipped = array2pil(element_array)
             image_ref = AlternativeImageType(comments=coords['features'] + ',clipped')
             element.add_AlternativeImage(image_ref)
@@ -1,31 +1,37 @@
 from __future__ import absolute_import
 
-from typing import Optional
-from logging import Logger
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+import multiprocessing as mp
 from sys import exit
-from os import makedirs, remove
+from os import makedirs
 from os.path import abspath, dirname, exists, join, isfile
 
-from ocrd_models import OcrdPage
-from ocrd import Processor, Workspace, OcrdPageResult
+import numpy as np
+
+from ocrd_modelfactory import page_from_file
+from ocrd_models.ocrd_page import to_xml
+from ocrd_utils import pushd_popd
+from ocrd import Processor, Workspace
 
 from .ocropus_rtrain import *
 from .binarize import binarize
 
 
-def deletefiles(filelist):
-    for file in filelist:
-        if exists(file):
-            remove(file)
-        if exists(file[:-3] + 'gt.txt'):
-            remove(file[:-3] + 'gt.txt')
-
 def resize_keep_ratio(image, baseheight=48):
     hpercent = (baseheight / float(image.size[1]))
     wsize = int((float(image.size[0] * float(hpercent))))
     image = image.resize((wsize, baseheight), Image.LANCZOS)
     return image
 
+def _extract_worker_init(processor):
+    # share the processor (with its workspace) with the forked worker
+    global _extract_processor
+    _extract_processor = processor
+
+def _extract_worker(index):
+    return _extract_processor.extract_page(index)
+
 
 class OcropyTrain(Processor):
     modelpath: str
@@ -52,63 +58,144 @@ class OcropyTrain(Processor):
         else:
             self.modelpath = None
             self.outputpath = join(self.parameter.get('outputpath', 'output'), 'lstm')
-        makedirs(dirname(self.outputpath))
-        self.filelist = None
+        makedirs(dirname(self.outputpath), exist_ok=True)
 
     def process_workspace(self, workspace: Workspace) -> None:
         """
         Trains a new model on the text lines from the input fileGrp,
-        extracted as image-text file pairs into the output fileGrp.
-        (If the output fileGrp already exists and these files should
-        be re-used, pass the `--overwrite` option when processing.)
+        extracted as image-text pairs into a single file `lines.npz`
+        in the output fileGrp.
+
+        Pages are extracted in `num_workers` processes in parallel.
+        Lines already in `lines.npz` from an earlier run (for the same
+        page image, segment and text) are re-used instead of being
+        extracted again.
+
+        (This does not process the workspace page by page like the
+        base class, so there is no per-page error handling, and
+        `--overwrite` does not apply: `lines.npz` is always updated
+        in place, keeping what can be re-used. Pages that fail to be
+        extracted are logged and skipped.)
 
         The model is written into `outputpath` (or just `output`) under
         the same name as `model` (i.e. the start model, or just `lstm`).
         """
-        self.filelist = []
-        super().process_workspace(workspace)
+        with pushd_popd(workspace.directory):
+            self.workspace = workspace
+            self.verify()
+            pairs = LinePairs(self.extract_lines())
         self.logger.info(f"Training {self.outputpath} from {self.modelpath or 'scratch'} "
-                         f"on {len(self.filelist)} file pairs")
-        rtrain(self.filelist, self.modelpath, self.outputpath, self.parameter['ntrain'])
-        # deletefiles(self.filelist)
+                         f"on {len(pairs)} line pairs")
+        rtrain(pairs, self.modelpath, self.outputpath, self.parameter['ntrain'],
+               batch_size=self.parameter['batch_size'],
+               num_workers=self.parameter['num_workers'],
+               sync_steps=self.parameter['sync_steps'],
+               validation=self.parameter['validation'],
+               patience=self.parameter['patience'],
+               sampler=self.parameter['sampler'],
+               seed=self.parameter['seed'])
+
+    def extract_lines(self):
+        """
+        Extracts the image-text pairs of all pages into `lines.npz`
+        in the output fileGrp (keeping those already extracted),
+        and returns its path.
+        """
+        fname = join(self.output_file_grp, 'lines.npz')
+        makedirs(self.output_file_grp, exist_ok=True)
+        old = LinePairs(fname) if exists(fname) else None
+        # known keys are inherited by the forked workers
+        self.extracted = old.index() if old else {}
+        self.pages = list(self.input_files)
+        num_workers = min(self.parameter['num_workers'], len(self.pages))
+        stats = dict(new=0, old=0)
+
+        def pairs(results):
+            for entries in results:
+                for key, name, image, gt in entries:
+                    if image is None:
+                        stats['old'] += 1
+                        _, image, gt = old[self.extracted[key]]
+                    else:
+                        stats['new'] += 1
+                    yield key, name, image, gt
+
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     mp_context=mp.get_context('fork'),
+                                     initializer=_extract_worker_init,
+                                     initargs=(self,)) as pool:
+                save_line_pairs(fname, pairs(pool.map(_extract_worker, range(len(self.pages)))))
+        else:
+            save_line_pairs(fname, pairs(map(self.extract_page, range(len(self.pages)))))
+        self.logger.info(f"Extracted {stats['new']} new and re-used {stats['old']} line pairs "
+                         f"from {len(self.pages)} pages into {fname}")
+        return fname
 
-    def process_page_pcgts(self, *input_pcgts: Optional[OcrdPage], page_id: Optional[str] = None) -> OcrdPageResult:
+    def extract_page(self, index):
         """
-        Extracts pairs of plaintext and cropped image files for each text line
-        in the PAGE file (to be used during training).
+        Extracts the image-text pairs for each text line (or word or glyph)
+        of the `index`-th input page (to be used during training).
+
+        Returns a list of key, name, image (as uint8 array) and text for each
+        segment with text. The key is a hash of the page image, the segment
+        (including its coordinates and text) and the coordinates, images and
+        orientation of its ancestors (region, line, word); segments with a key in
+        `self.extracted` are not extracted again (returning no image).
+        If the page cannot be extracted, logs the error and returns nothing.
         """
-        pcgts = input_pcgts[0]
-        #self.logger.info("Using model %s in %s for recognition", model)
+        input_file = self.pages[index]
+        page_id = input_file.pageId
+        try:
+            return self._extract_page(input_file, page_id)
+        except Exception as err:
+            self.logger.error(f"Skipping page '{page_id}' which cannot be extracted: {err}")
+            return []
+
+    def _extract_page(self, input_file, page_id):
+        pcgts = page_from_file(input_file)
         page = pcgts.get_Page()
         page_image, page_coords, _ = self.workspace.image_from_page(page, page_id)
+        digest = sha1(page_image.mode.encode('utf-8'))
+        digest.update(np.array(page_image.size).tobytes())
+        digest.update(page_image.tobytes())
 
         self.logger.debug(f"Extracting from page '{page_id}'")
+        entries = []
+        def extract(name, segment, *ancestors):
+            key = digest.copy()
+            # the crop also depends on the ancestors' coordinates and images
+            # (but not on their other children)
+            for ancestor in ancestors:
+                key.update(ancestor.get_Coords().points.encode('utf-8'))
+                for alternative_image in ancestor.get_AlternativeImage():
+                    key.update(f"{alternative_image.filename} {alternative_image.comments}".encode('utf-8'))
+                key.update(str(getattr(ancestor, 'orientation', None)).encode('utf-8'))
+            key.update(to_xml(segment).encode('utf-8'))
+            key = key.hexdigest()
+            if key in self.extracted:
+                self.logger.debug(f"Reusing {segment.__class__.__name__} '{segment.id}' pair")
+                entries.append((key, name, None, None))
+                return
+            extracted = self.extract_segment(segment, page_image, page_coords)
+            if extracted:
+                entries.append((key, name) + extracted)
         for region in page.get_AllRegions(classes=['Text']):
             textlines = region.get_TextLine()
             self.logger.debug(f"Extracting {len(textlines)} lines from region '{region.id}'")
             for line in textlines:
                 if self.parameter['textequiv_level'] == 'line':
-                    path = join(self.output_file_grp, f"{page_id}_{region.id}_{line.id}")
-                    self.filelist.append(self.extract_segment(path, line, page_image, page_coords))
+                    extract(f"{page_id}_{region.id}_{line.id}", line, region)
                     continue
                 for word in line.get_Word():
                     if self.parameter['textequiv_level'] == 'word':
-                        path = join(self.output_file_grp, f"{page_id}_{region.id}_{line.id}_{word.id}")
-                        self.filelist.append(self.extract_segment(path, word, page_image, page_coords))
+                        extract(f"{page_id}_{region.id}_{line.id}_{word.id}", word, region, line)
                         continue
                     for glyph in word.get_Glyph():
-                        path = join(self.output_file_grp, f"{page_id}_{region.id}_{line.id}_{word.id}_{glyph.id}")
-                        self.filelist.append(self.extract_segment(path, glyph, page_image, page_coords))
-        # FIXME: PAGE-XML not really needed, find a way around this (raising special exception?)
-        return OcrdPageResult(pcgts)
-
-    def extract_segment(self, path, segment, page_image, page_coords):
-        gtpath = path + '.gt.txt'
-        imgpath = path + '.png'
-        if exists(gtpath) and exists(imgpath):
-            self.logger.debug(f"Reusing {segment.__class__.__name__} '{segment.id}' file pair")
-            return imgpath
+                        extract(f"{page_id}_{region.id}_{line.id}_{word.id}_{glyph.id}", glyph, region, line, word)
+        return entries
 
+    def extract_segment(self, segment, page_image, page_coords):
         gt = segment.TextEquiv
         if not gt:
             return None
@@ -116,10 +203,8 @@ class OcropyTrain(Processor):
         if not gt or not gt.strip():
             return None
         gt = gt.strip()
-        with open(gtpath, "w", encoding='utf-8') as f:
-            f.write(gt)
 
-        self.logger.debug(f"Extracting {segment.__class__.__name__} '{segment.id}' file pair")
+        self.logger.debug(f"Extracting {segment.__class__.__name__} '{segment.id}' pair")
         image, coords = self.workspace.image_from_segment(segment, page_image, page_coords)
 
         if 'binarized' not in coords['features'].split(','):
@@ -129,6 +214,5 @@ class OcropyTrain(Processor):
         # resize image to 48 pixel height
         image = resize_keep_ratio(image)
 
-        image.save(imgpath)
-
-        return imgpath
+        # same as reading back a PNG file with read_image_gray
+        return np.array(image.convert('L')), gt